@@ -0,0 +1,497 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import database
+from emissions import Co2eCalculator, get_emission_stats_modes, journey_specifications
+from roundup import add_record_to_weekly_stats, rebuild_weekly_stats
+from stats import add_to_monthly_stats, bump_stats_version, rebuild_monthly_stats
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'STEP_journey_checker')))
+
+from STEP_journey_checker.journey_checker import analyse_journey
+
+# Name of the CacheVersions row bumped every time the CO2e emission factors change
+EMISSION_FACTORS_CACHE = "emission factors"
+
+# The maximum number of analysis results kept in the AnalysisCache table, the least recently used are evicted first
+ANALYSIS_CACHE_SIZE = 10000
+
+# The number of CarbonEmissionStats rows recomputed per transaction by recompute_co2e()
+RECOMPUTE_CHUNK_SIZE = 5000
+
+# Kilometers of a record not covered by the CarbonEmissionStats columns above which recompute_co2e() skips it
+UNCOVERED_DISTANCE_TOLERANCE = 1e-6
+
+# Memory-backed folder the journey checker reads small traces from, when the system has one
+MEMORY_TEMP_FOLDER = "/dev/shm"
+
+# The maximum size in bytes of a trace kept in MEMORY_TEMP_FOLDER, larger traces go to the regular temporary folder
+IN_MEMORY_TRACE_LIMIT = 8 * 1024 * 1024
+
+def get_trace_folder(size):
+    """
+    Get the folder the temporary copy of a trace is created in.
+
+    Args:
+        size (int): Size of the trace in bytes.
+
+    Returns:
+        str: MEMORY_TEMP_FOLDER for small traces if it exists, None for the default temporary folder.
+    """
+    if size <= IN_MEMORY_TRACE_LIMIT and os.path.isdir(MEMORY_TEMP_FOLDER) and os.access(MEMORY_TEMP_FOLDER, os.W_OK):
+        return MEMORY_TEMP_FOLDER
+    return None
+
+def analyse_trace(trace, filename):
+    """
+    Run the journey checker on an uploaded trace.
+
+    The checker only reads journeys from a path, so the trace is written, without being
+    copied in memory, to a private temporary directory under its original name and removed
+    once the analysis is done. Small traces are written to a memory-backed folder so the
+    analysis does no disk I/O, and each analysis has its own directory so uploads with the
+    same name never collide.
+
+    Args:
+        trace (bytes | memoryview): Content of the uploaded journey file.
+        filename (str): Secure name of the uploaded file.
+
+    Returns:
+        tuple: Whether the journey is validated and the distance travelled by each mode in meters.
+    """
+    trace = memoryview(trace)
+    with tempfile.TemporaryDirectory(prefix="step-", dir=get_trace_folder(trace.nbytes)) as folder:
+        path = os.path.join(folder, filename or "journey.json")
+        with open(path, 'wb') as file:
+            file.write(trace)
+        # The day you want to calculate CO2e differently depending on the specification (particularly for
+        # petrol, diesel, hybrid cars, etc.), it may be necessary to change the structure returned by
+        # distance_by_modes to take account of each specification. If you change distance_by_modes,
+        # make sure you adapt each location where it was used.
+        return analyse_journey(path)
+
+def trace_digest(trace):
+    """
+    Get the key of a trace in the analysis cache.
+
+    Args:
+        trace (bytes | memoryview): Content of the uploaded journey file.
+
+    Returns:
+        str: Hexadecimal SHA-256 of the trace.
+    """
+    return hashlib.sha256(trace).hexdigest()
+
+def get_cached_analyses(digests):
+    """
+    Get the stored results of traces analysed before, and mark them as recently used.
+
+    The results are read without taking the write lock, so a miss never waits for the
+    other workers. Only the hits are written to, in one short transaction.
+
+    Args:
+        digests (list): SHA-256 of the traces.
+
+    Returns:
+        dict: Whether each journey is validated and the distance travelled by each mode, by digest, for the traces analysed before.
+    """
+    digests = json.dumps(list(digests))
+    con = database.get_db()
+    rows = con.execute("""
+        SELECT digest, result, distanceByModes FROM AnalysisCache WHERE digest IN (SELECT value FROM json_each(?))
+    """, (digests,)).fetchall()
+    if rows:
+        touch_cached_analyses([row[0] for row in rows])
+    return {digest: (bool(result), json.loads(distance_by_modes)) for digest, result, distance_by_modes in rows}
+
+def get_cached_analysis(digest):
+    """
+    Get the stored result of a trace analysed before, and mark it as recently used.
+
+    Args:
+        digest (str): SHA-256 of the trace.
+
+    Returns:
+        tuple: Whether the journey is validated and the distance travelled by each mode, or None if the trace was never analysed.
+    """
+    return get_cached_analyses([digest]).get(digest)
+
+@database.retry_on_locked
+def touch_cached_analyses(digests):
+    """
+    Count a hit on stored analysis results and mark them as recently used.
+
+    Args:
+        digests (list): SHA-256 of the traces found in the analysis cache.
+    """
+    with database.transaction() as cur:
+        cur.execute("""
+            UPDATE AnalysisCache SET hits = hits + 1, lastUsedAt = ? WHERE digest IN (SELECT value FROM json_each(?))
+        """, (datetime.now().isoformat(), json.dumps(digests)))
+
+@database.retry_on_locked
+def store_cached_analysis(digest, result, distance_by_modes):
+    """
+    Store the result of an analysis, evicting the least recently used results above ANALYSIS_CACHE_SIZE.
+
+    Args:
+        digest (str): SHA-256 of the trace.
+        result (bool): Whether the journey is validated.
+        distance_by_modes (dict): Distance travelled by each mode in meters.
+    """
+    now = datetime.now().isoformat()
+    with database.transaction() as cur:
+        cur.execute("""
+            INSERT INTO AnalysisCache (digest, result, distanceByModes, createdAt, lastUsedAt) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (digest) DO UPDATE SET lastUsedAt = excluded.lastUsedAt
+        """, (digest, result, json.dumps(distance_by_modes), now, now))
+        excess = cur.execute("SELECT COUNT(*) FROM AnalysisCache").fetchone()[0] - ANALYSIS_CACHE_SIZE
+        if excess > 0:
+            cur.execute("""
+                DELETE FROM AnalysisCache WHERE digest IN (
+                    SELECT digest FROM AnalysisCache ORDER BY lastUsedAt LIMIT ?
+                )
+            """, (excess,))
+
+def analyse_and_cache_trace(trace, filename):
+    """
+    Run the journey checker on a trace and store the outcome in the analysis cache.
+
+    Clients retry their uploads, so the outcome of each analysis is stored under the
+    SHA-256 of the trace, and looked up with get_cached_analyses() before a trace is sent
+    to the process pool. Failed analyses are not stored, they are run again on retry.
+
+    Args:
+        trace (bytes | memoryview): Content of the uploaded journey file.
+        filename (str): Secure name of the uploaded file.
+
+    Returns:
+        tuple: Whether the journey is validated and the distance travelled by each mode in meters.
+    """
+    result, distance_by_modes = analyse_trace(trace, filename)
+    store_cached_analysis(trace_digest(trace), result, distance_by_modes)
+    return result, distance_by_modes
+
+class EmissionFactorRegistry:
+    """
+    In-memory cache of the CO2e emission factors of each transport method and specification.
+
+    The factors are reference data that almost never change, so they are loaded with a single
+    query and kept until the EMISSION_FACTORS_CACHE version changes. The version is bumped by
+    triggers on the factor, method and specification tables, so every process picks up a
+    corrected factor on its next use, whatever the process or tool modifying it.
+
+    Methods with a single factor are stored under the 'default' specification, methods with
+    several factors under the name of each specification, both in lower case.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._factors = None
+        self._calculator = None
+        self._version = None
+
+    def _load(self, cur, version):
+        rows = cur.execute('''
+            SELECT m.name AS methodName, ms.name AS specificationName, cef.co2eFactor,
+                   COUNT(*) OVER (PARTITION BY cef.methodId) AS methodFactorCount
+            FROM CarbonEmissionFactors cef
+            JOIN Methods m ON cef.methodId = m.methodId
+            LEFT JOIN CarbonEmissionFactorSpecifications ceff
+                ON ceff.carbonEmissionFactorId = cef.carbonEmissionFactorId AND ceff.methodId = cef.methodId
+            LEFT JOIN MethodsSpecifications ms ON ceff.specificationId = ms.specificationId
+        ''').fetchall()
+
+        factors = {}
+        emission_dict = {}
+        for method_name, specification_name, co2e_factor, method_factor_count in rows:
+            method = method_name.lower()
+            specifications = emission_dict.setdefault(method, {})
+            if method_factor_count == 1:
+                specification = "default"
+            elif specification_name is not None:
+                specification = specification_name.lower()
+            else:
+                continue
+            factors[(method, specification)] = co2e_factor
+            specifications[specification] = co2e_factor
+
+        self._factors = factors
+        self._calculator = Co2eCalculator(emission_dict)
+        self._version = version
+
+    def _ensure_loaded(self):
+        cur = database.get_db().cursor()
+        version = get_emission_factors_version(cur)
+        if self._factors is None or self._version != version:
+            with self._lock:
+                if self._factors is None or self._version != version:
+                    self._load(cur, version)
+
+    def get(self, method, specification="default"):
+        """
+        Get the CO2e emission factor of a method and specification.
+
+        Args:
+            method (str): Name of the transport method, e.g. 'walk' or 'car'.
+            specification (str): Name of the specification, 'default' for methods with a single factor.
+
+        Returns:
+            float: CO2e emitted per kilometer.
+
+        Raises:
+            KeyError: No factor is defined for this method and specification.
+        """
+        self._ensure_loaded()
+        return self._factors[(method.lower(), specification.lower())]
+
+    def calculator(self):
+        """
+        Get the CO2e calculator built from the current factors.
+
+        Returns:
+            Co2eCalculator: Calculator using every factor of the registry.
+        """
+        self._ensure_loaded()
+        return self._calculator
+
+def get_emission_factors_version(cur):
+    """
+    Get the current version of the CO2e emission factors.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor to run the query with.
+
+    Returns:
+        int: Version bumped by every change to the factors, their methods or their specifications.
+    """
+    row = cur.execute("SELECT version FROM CacheVersions WHERE name=?", (EMISSION_FACTORS_CACHE,)).fetchone()
+    return row[0] if row else 0
+
+@database.retry_on_locked
+def invalidate_emission_factors():
+    """
+    Make every process load the CO2e emission factors again on their next use.
+    """
+    with database.transaction() as cur:
+        cur.execute('''
+            INSERT INTO CacheVersions (name, version) VALUES (?, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1
+        ''', (EMISSION_FACTORS_CACHE,))
+
+# Factors shared by every analysis run in this process
+emission_factors = EmissionFactorRegistry()
+
+def insert_emission_stats(cur, date, record_ids, modes, km, co2e, used):
+    """
+    Insert the CarbonEmissionStats rows of a batch of records and add them to the monthly statistics rollup.
+
+    Every mode with its own columns in CarbonEmissionStats is written, the other modes only
+    count in the rollup.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor of the transaction.
+        date (datetime): Date of the rows.
+        record_ids (list): ID of the record of each row.
+        modes (list): Modes in lower case, with km, co2e and used as returned by Co2eCalculator.calculate_records().
+        km (np.ndarray): Kilometers travelled by each mode of each record.
+        co2e (np.ndarray): CO2e emitted by each mode of each record.
+        used (np.ndarray): Whether each mode of each record was used.
+    """
+    names = {mode.lower(): mode for mode in get_emission_stats_modes(cur)}
+    positions = {mode: index for index, mode in enumerate(modes)}
+    stored = [(name, positions.get(mode)) for mode, name in names.items()]
+    km, co2e, used = km.tolist(), co2e.tolist(), used.tolist()
+
+    columns = [f"is{name}Used" for name, _ in stored] + [f"km{name}" for name, _ in stored] + [f"co2e{name}" for name, _ in stored]
+    rows = []
+    for row, record_id in enumerate(record_ids):
+        values = [used[row][index] if index is not None else False for _, index in stored]
+        values += [km[row][index] if index is not None else 0 for _, index in stored]
+        values += [co2e[row][index] if index is not None else 0 for _, index in stored]
+        rows.append((record_id, date, *values))
+    cur.executemany(f"""
+        INSERT INTO CarbonEmissionStats (recordId, date, {", ".join(columns)})
+        VALUES (?, ?, {", ".join("?" * len(columns))})
+    """, rows)
+
+    for row in range(len(record_ids)):
+        modes_used = [(names.get(mode, mode.capitalize()), km[row][index], co2e[row][index]) for index, mode in enumerate(modes) if used[row][index]]
+        add_to_monthly_stats(cur, date, modes_used)
+
+@database.retry_on_locked
+def finalise_records(outcomes):
+    """
+    Update records with the outcome of their journey analysis, in a single transaction.
+
+    Each record leaves the pending state, and when its journey is validated its CO2e emissions
+    are stored, the CO2e saved is written on the record and the monthly and weekly statistics
+    are updated. Every write happens on the same connection and is committed at once, with
+    one executemany() per statement, so a crash never leaves a record half finalised.
+
+    Only the records still pending are updated, so finalising a record again, e.g. when a job
+    is run a second time, changes nothing.
+
+    Args:
+        outcomes (list): (record_id, result, distance_by_modes) tuples, a failed analysis having a False result and no distance.
+
+    Returns:
+        list: IDs of the records finalised as integers, without the ones that were not pending.
+    """
+    date = datetime.now()
+    outcomes = [(int(record_id), result, distance_by_modes) for record_id, result, distance_by_modes in outcomes]
+
+    with database.transaction() as cur:
+        # Read inside the transaction, so a factor corrected before it commits is never missed
+        calculator = emission_factors.calculator()
+        record_ids = [record_id for record_id, _, _ in outcomes]
+        pending = dict(cur.execute(f"""
+            SELECT r.recordId, j.methodsJson
+            FROM Records r
+            LEFT JOIN Journeys j ON r.journeyId = j.journeyId
+            WHERE r.isPending = 1 AND r.recordId IN ({', '.join('?' * len(record_ids))})
+        """, record_ids).fetchall())
+        outcomes = [outcome for outcome in outcomes if outcome[0] in pending]
+
+        validated = [(record_id, distance_by_modes) for record_id, result, distance_by_modes in outcomes if result == True]
+        co2e_saved_rows = []
+        if validated:
+            modes, km, co2e, used, co2e_saved = calculator.calculate_records(
+                [distance_by_modes for _, distance_by_modes in validated],
+                [journey_specifications(pending[record_id]) for record_id, _ in validated],
+            )
+            insert_emission_stats(cur, date, [record_id for record_id, _ in validated], modes, km, co2e, used)
+            co2e_saved_rows = list(zip(co2e_saved.tolist(), [record_id for record_id, _ in validated]))
+
+        cur.executemany("UPDATE Records SET isValidated=?, isPending=?, nbMethodUsed=?, kmTravelled=? WHERE recordId=?", [
+            (result, False, len(distance_by_modes), sum(distance_by_modes.values())/1000, record_id)
+            for record_id, result, distance_by_modes in outcomes
+        ])
+        cur.executemany("UPDATE Records SET co2Saved=? WHERE recordId=?", co2e_saved_rows)
+        for _, record_id in co2e_saved_rows:
+            add_record_to_weekly_stats(cur, record_id)
+        bump_stats_version(cur)
+    return [record_id for record_id, _, _ in outcomes]
+
+def finalise_record(record_id, result, distance_by_modes):
+    """
+    Update a record with the outcome of its journey analysis, in a single transaction.
+
+    Args:
+        record_id (int): ID of the analysed record.
+        result (bool): Whether the journey was validated, False when the analysis failed.
+        distance_by_modes (dict): Distance travelled by each mode in meters, empty when the analysis failed.
+
+    Returns:
+        bool: True if the record was finalised, False if it was not pending.
+    """
+    return bool(finalise_records([(record_id, result, distance_by_modes)]))
+
+@database.retry_on_locked
+def recompute_co2e_chunk(calculator, names, after_id, chunk_size):
+    """
+    Recompute the CO2e of a chunk of CarbonEmissionStats rows and of their records, in one transaction.
+
+    Only the distance of the modes with their own columns is stored for each record, so the
+    records that also travelled with other modes cannot be priced again: they are skipped
+    and keep the CO2e computed when they were finalised.
+
+    Args:
+        calculator (Co2eCalculator): Calculator with the current factors.
+        names (list): Modes with their own columns in CarbonEmissionStats, as written in the columns.
+        after_id (int): ID of the last row of the previous chunk.
+        chunk_size (int): Maximum number of rows in the chunk.
+
+    Returns:
+        tuple: ID of the last row of the chunk, or None if there was no row left, number of rows recomputed and number of rows skipped.
+    """
+    modes = [name.lower() for name in names]
+    with database.transaction() as cur:
+        rows = cur.execute(f"""
+            SELECT c.carbonEmissionStatId, c.recordId, r.kmTravelled, j.methodsJson,
+                   {", ".join(f"c.km{name}" for name in names)}
+            FROM CarbonEmissionStats c
+            LEFT JOIN Records r ON c.recordId = r.recordId
+            LEFT JOIN Journeys j ON r.journeyId = j.journeyId
+            WHERE c.carbonEmissionStatId > ?
+            ORDER BY c.carbonEmissionStatId
+            LIMIT ?
+        """, (after_id, chunk_size)).fetchall()
+        if not rows:
+            return None, 0, 0
+        last_id = rows[-1][0]
+
+        km = np.nan_to_num(np.array([row[4:] for row in rows], dtype=float))
+        km_travelled = np.array([row[2] if row[2] is not None else np.nan for row in rows], dtype=float)
+        km_travelled = np.where(np.isnan(km_travelled), km.sum(axis=1), km_travelled)
+        # Records that also travelled with modes without their own columns cannot be priced again
+        covered = km_travelled - km.sum(axis=1) < UNCOVERED_DISTANCE_TOLERANCE
+        skipped = len(rows) - int(covered.sum())
+        rows = [row for row, keep in zip(rows, covered) if keep]
+        km, km_travelled = km[covered], km_travelled[covered]
+        if not rows:
+            return last_id, 0, skipped
+
+        factor_columns = np.tile([calculator.factor_column(mode) for mode in modes], (len(rows), 1))
+        for index, row in enumerate(rows):
+            if row[3]:
+                specifications = journey_specifications(row[3])
+                factor_columns[index] = [calculator.factor_column(mode, specifications.get(mode, ())) for mode in modes]
+        co2e, _ = calculator.calculate(km, factor_columns)
+        co2e_saved = km_travelled * calculator.reference - co2e.sum(axis=1)
+
+        cur.executemany(
+            f"UPDATE CarbonEmissionStats SET {', '.join(f'co2e{name}=?' for name in names)} WHERE carbonEmissionStatId=?",
+            [(*values, row[0]) for values, row in zip(co2e.tolist(), rows)]
+        )
+        cur.executemany(
+            "UPDATE Records SET co2Saved=? WHERE recordId=? AND isValidated = 1",
+            [(value, row[1]) for value, row in zip(co2e_saved.tolist(), rows)]
+        )
+        return last_id, len(rows), skipped
+
+def recompute_co2e(chunk_size=RECOMPUTE_CHUNK_SIZE):
+    """
+    Recompute the CO2e of every journey with the current emission factors.
+
+    The kilometers of each mode already stored in CarbonEmissionStats are read in chunks
+    ordered by ID, recomputed in one NumPy pass per chunk and written back with executemany(),
+    one transaction per chunk. The CO2e saved by the records follows, then the monthly and
+    weekly statistics are rebuilt. Used after a CarbonEmissionFactors value is corrected.
+
+    The factors are invalidated in every process first, so the records finalised while the
+    command runs use the corrected factors too.
+
+    Args:
+        chunk_size (int): Number of rows recomputed per transaction.
+
+    Returns:
+        tuple: Number of CarbonEmissionStats rows recomputed, number of rows skipped because their
+        record used modes without their own columns, and time taken in seconds.
+    """
+    invalidate_emission_factors()
+    calculator = emission_factors.calculator()
+    names = get_emission_stats_modes(database.get_db().cursor())
+
+    started = time.monotonic()
+    rows = 0
+    skipped = 0
+    after_id = 0
+    while True:
+        after_id, count, chunk_skipped = recompute_co2e_chunk(calculator, names, after_id, chunk_size)
+        if after_id is None:
+            break
+        rows += count
+        skipped += chunk_skipped
+
+    rebuild_monthly_stats()
+    rebuild_weekly_stats()
+    return rows, skipped, time.monotonic() - started
@@ -1,5 +1,5 @@
 import os
-from flask import Flask, request, render_template, jsonify, send_file
+from flask import Flask, request, render_template, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from users import *
@@ -7,19 +7,18 @@ from journeys import *
 from auth import *
 from records import *
 from methods import *
+from jobs import *
+from stats import *
+from roundup import *
+from pagination import *
+from analysis import *
+from images import *
+import click
+import sessions
 import sqlite3
-from datetime import datetime, timedelta
-
 import sys
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'STEP_journey_checker')))
-
-from STEP_journey_checker.journey_checker import analyse_journey
-
-# The maximum number of journey files the server will store
-MAX_JOURNEY_FILES = 1000
-
-# The folder where journeys are stored
-JOURNEYS_FOLDER = "journeys/"
+import threading
+from datetime import datetime, timedelta
 
 # The password to fetch the journey stored on the server
 ADMIN_PASSWORD = "Zélie est une vilaine fille"
@@ -29,8 +28,36 @@ app = Flask(__name__)
 # Allow CORS
 CORS(app)
 
+# Release pooled database connections at the end of each request
+database.init_app(app)
+
+# Sign the session tokens issued at login
+sessions.init_app(app)
+
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
 
+_started = False
+_started_lock = threading.Lock()
+
+@app.before_request
+def start_server_process():
+    """
+    Prepare the server process before its first request.
+
+    Restarts the journey analyses interrupted by the last shutdown, and takes into account
+    the journey files added or removed while the server was stopped. This is not done when
+    the module is imported: the analysis workers import it again when the server is run as
+    a script, and the CLI commands import it too.
+    """
+    global _started
+    if _started:
+        return
+    with _started_lock:
+        if not _started:
+            resume_analysis_jobs()
+            sync_journey_manifest()
+            _started = True
+
 @app.route("/")
 def hello_world():
     """
@@ -72,17 +99,22 @@ def get_user_profile_image(user_id):
         - GET
     URL parameters:
         - user_id: ID of the user whose profile image is to be fetched.
+        - size (optional): 'small', 'medium' or 'large' (default), see PROFILE_IMAGE_SIZES.
     Possible returns:
         - 200 (OK): Profile image retrieved successfully.
+        - 304 (Not Modified): The client's copy, sent in If-None-Match, is still current.
+        - 400 (Bad Request): Unknown size.
         - 404 (Not Found): Profile image not found.
     """
-    user_pictures_folder = 'user_pictures'
-    filename = os.path.join(user_pictures_folder, f"{user_id}.png")
-    
-    if os.path.exists(filename):
-        return send_file(filename, mimetype='image/png')
-    else:
+    size = request.args.get("size", DEFAULT_PROFILE_IMAGE_SIZE)
+    if size not in PROFILE_IMAGE_SIZES:
+        return {"error": f"size must be one of {', '.join(PROFILE_IMAGE_SIZES)}"}, 400
+    image = find_profile_image(user_id, size)
+    if image is None:
         return {"error": "Profile image not found"}, 404
+    filename, mimetype = image
+    return send_file(filename, mimetype=mimetype, etag=get_profile_image_etag(filename),
+                     max_age=PROFILE_IMAGE_MAX_AGE, conditional=True)
 
 @app.post("/api/user")
 def receive_user():
@@ -100,7 +132,7 @@ def receive_user():
         }
     Possible returns:
         - 201 (Created): The user has been created successfully.
-        - 400 (Bad Request): The user name already exists in the database.
+        - 400 (Bad Request): The user name already exists in the database, or the profile image is not a valid image.
         - 500 (Internal Server Error): User creation failed for an unknown reason.
     """
     return register_user(request.form, request.files)
@@ -117,12 +149,29 @@ def receive_login():
             "password": "Password"
         }
     Possible returns:
-        - 200 (OK): Login successful, returns user ID.
+        - 200 (OK): Login successful, returns user ID and session token.
         - 401 (Unauthorized): Invalid credentials.
         - 500 (Internal Server Error): Connection attempt error for unknown reason.
     """
     return login_user(request.json)
 
+@app.get("/api/session")
+def send_session():
+    """
+    API route used to get the user of a session token, without reading the database for a recently resolved token.
+    Method:
+        - GET
+    Expected headers:
+        - Authorization: Bearer <token returned by /api/login>
+    Possible returns:
+        - 200 (OK): Returns the user ID and username of the session.
+        - 401 (Unauthorized): Missing, invalid or expired token, or deleted user.
+    """
+    user = sessions.get_current_user()
+    if user is None:
+        return {"error": "Invalid or expired session"}, 401
+    return {"user": user}, 200
+
 @app.delete('/api/user/<user_id>')
 def delete_user(user_id):
     """
@@ -137,6 +186,37 @@ def delete_user(user_id):
     """
     return remove_user(user_id)
 
+@app.cli.command("purge-users")
+@click.argument("user_ids", nargs=-1, type=int)
+@click.option("--file", "ids_file", type=click.File(), help="File with one user ID per line.")
+@click.option("--batch-size", default=500, show_default=True, help="Users deleted per transaction.")
+def purge_users_command(user_ids, ids_file, batch_size):
+    """
+    Delete users and all their data, e.g. for a GDPR sweep.
+    Usage:
+        flask purge-users 12 13 14
+        flask purge-users --file user_ids.txt
+    """
+    user_ids = list(user_ids)
+    if ids_file:
+        user_ids += [int(line) for line in ids_file if line.strip()]
+    deleted = 0
+    for start in range(0, len(user_ids), batch_size):
+        deleted += len(delete_users(user_ids[start:start + batch_size]))
+    print(f"Users deleted: {deleted} of {len(user_ids)} requested")
+
+@app.cli.command("convert-profile-images")
+def convert_profile_images_command():
+    """
+    Store the sized WebP variants of the profile pictures uploaded before they existed.
+    Usage:
+        flask convert-profile-images
+    """
+    converted, invalid = convert_profile_images()
+    print(f"Profile images converted: {converted}")
+    if invalid:
+        print(f"Not valid images, kept as they are: {', '.join(invalid)}")
+
 # ----------------------------------------------------------------------
 # Journeys
 # ----------------------------------------------------------------------
@@ -151,14 +231,53 @@ def send_journey_data():
         {
             "password": "Admin password"
         }
+    Optional query parameters:
+        - format: 'ndjson' to stream one journey per line instead of a single JSON list.
+        With format=ndjson only:
+        - mode: Only journeys using this mode, e.g. 'bus' or 'luas-Red'.
+        - since / until: Only journeys stored at or after / before this ISO date.
+        - limit: Maximum number of journeys. The cursor of the next page is sent in the X-Next-Cursor header.
+        - cursor: Cursor of the page to fetch.
     Possible returns:
         - 200 (OK): Data retrieved successfully.
+        - 400 (Bad Request): Invalid limit or cursor.
+        - 401 (Unauthorized): Invalid password.
+    """
+    data = request.get_json()
+    if not ("password" in data and data["password"] == ADMIN_PASSWORD):
+        return "Unauthorized", 401
+    if request.args.get("format") != "ndjson":
+        return jsonify(get_journey_files())
+    try:
+        limit = request.args.get("limit", type=int)
+        if limit is not None and limit <= 0:
+            raise ValueError("Invalid limit")
+        filenames, next_cursor = find_journey_files(request.args.get("mode"), request.args.get("since"), request.args.get("until"), request.args.get("cursor"), limit)
+    except ValueError as e:
+        return str(e), 400
+    response = Response(stream_with_context(iter_journey_lines(filenames)), mimetype='application/x-ndjson')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@app.get("/api/journey_files")
+def send_journey_files():
+    """
+    API route used to list the stored journey files without their content.
+    Method:
+        - GET
+    Expected JSON request:
+        {
+            "password": "Admin password"
+        }
+    Possible returns:
+        - 200 (OK): Number and total size of the files, and the name, size, journey string and creation date of each file.
         - 401 (Unauthorized): Invalid password.
     """
     data = request.get_json()
     if not ("password" in data and data["password"] == ADMIN_PASSWORD):
         return "Unauthorized", 401
-    return jsonify(get_journey_files())
+    return jsonify(list_journey_files())
 
 @app.get("/api/journey/user/<user_id>")
 def send_journeys(user_id):
@@ -168,12 +287,23 @@ def send_journeys(user_id):
         - GET
     URL parameters:
         - user_id: ID of the user whose journeys are to be fetched.
+    Optional query parameters, returning a page of journeys instead of all of them:
+        - limit: Maximum number of journeys in the page.
+        - cursor: Cursor of the page, returned as nextCursor with the previous page.
+        - fields: Comma-separated fields of each journey to return.
     Possible returns:
         - 200 (OK): Journeys retrieved successfully.
+        - 400 (Bad Request): Invalid limit, cursor or fields.
         - 404 (Not Found): No journeys found for the given user ID.
         - 500 (Internal Server Error): Error retrieving journeys.
     """
-    return get_user_journeys(user_id)
+    try:
+        page = parse_page_args(request.args, JOURNEY_FIELDS)
+        if page is None:
+            return get_user_journeys(user_id)
+        return find_user_journeys(user_id, *page)
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
 @app.get("/api/journey/<journey_id>")
 def send_journey(journey_id):
@@ -216,8 +346,7 @@ def receive_journey_data():
         - 201 (Created): Data successfully stored.
         - 507 (Insufficient Storage): Too many files on the server.
     """
-    if len(os.listdir(JOURNEYS_FOLDER)) < MAX_JOURNEY_FILES:
-        store_file(request.get_json())
+    if store_file(request.get_json()):
         return "Data successfully stored on the server", 201
     else:
         return "Too many files on the server", 507
@@ -248,10 +377,10 @@ def upload_journey_file():
     Method:
         - POST
     Expected multipart form-data request:
-        - file: The JSON file containing journey data.
+        - file: The JSON file containing journey data, or a compact trace (.trace).
     Possible returns:
         - 201 (Created): File successfully uploaded and stored.
-        - 400 (Bad Request): No file part or no selected file.
+        - 400 (Bad Request): No file part or no selected file, or the file is not a valid journey file.
         - 507 (Insufficient Storage): Too many files on the server.
     """
     if 'file' not in request.files:
@@ -261,9 +390,11 @@ def upload_journey_file():
     if file.filename == '':
         return "No selected file", 400
 
-    if len(os.listdir(JOURNEYS_FOLDER)) < MAX_JOURNEY_FILES:
-        filename = os.path.join(JOURNEYS_FOLDER, secure_filename(file.filename))
-        file.save(filename)
+    try:
+        stored = save_uploaded_journey_file(file)
+    except ValueError as e:
+        return str(e), 400
+    if stored:
         return "File successfully uploaded", 201
     else:
         return "Too many files on the server", 507
@@ -302,6 +433,19 @@ def delete_journey_data():
         return "Unauthorized", 401
     return delete_all_journey_files()
 
+@app.cli.command("convert-journeys")
+def convert_journeys_command():
+    """
+    Convert the journey files stored as JSON to the compact trace format.
+    Usage:
+        flask convert-journeys
+    """
+    converted, size_before, size_after, invalid = convert_journey_files()
+    ratio = f" ({size_after / size_before:.0%} of the original size)" if size_before else ""
+    print(f"Journey files converted: {converted}, {size_before} bytes -> {size_after} bytes{ratio}")
+    if invalid:
+        print(f"Not valid journey files, kept as they are: {', '.join(invalid)}")
+
 # ----------------------------------------------------------------------
 # Methods & Specifications
 # ----------------------------------------------------------------------
@@ -360,17 +504,29 @@ def get_user_records(user_id):
         - GET
     URL parameters:
         - user_id: ID of the user whose records are to be fetched.
+    Optional query parameters, returning a page of records, newest first, instead of all of them:
+        - limit: Maximum number of records in the page.
+        - cursor: Cursor of the page, returned as nextCursor with the previous page.
+        - fields: Comma-separated fields of each record to return.
     Possible returns:
         - 200 (OK): Records retrieved successfully.
+        - 400 (Bad Request): Invalid limit, cursor or fields.
         - 404 (Not Found): No records found for the given user ID.
         - 500 (Internal Server Error): Error retrieving records.
     """
-    return jsonify(get_all_user_records(user_id))
+    try:
+        page = parse_page_args(request.args, RECORD_FIELDS)
+        if page is None:
+            return jsonify(get_all_user_records(user_id))
+        return find_user_records(user_id, *page)
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
 @app.post("/api/analyse_journey_file")
 def analyse_journey_file():
     """
-    API route used to analyze a journey file.
+    API route used to queue the analysis of a journey file.
+    The analysis runs in the background, the record stays pending until it is done.
     Method:
         - POST
     Expected multipart form-data request:
@@ -378,135 +534,81 @@ def analyse_journey_file():
         - recordId: The ID of the journey record.
         - username: The username of the user.
     Possible returns:
-        - 200 (OK): File successfully analyzed.
-        - 400 (Bad Request): No file part or recordId or username.
-        - 500 (Internal Server Error): Error during file analysis.
+        - 200 (OK): Same file already analysed, returns the finished job.
+        - 202 (Accepted): Analysis queued, returns the job ID to poll.
+        - 400 (Bad Request): No file part or recordId or username, or recordId is not an integer.
+        - 500 (Internal Server Error): Error queuing the analysis.
     """
     if 'file' not in request.files or 'recordId' not in request.form:
         return "No file part or recordId or username", 400
 
     file = request.files['file']
-    record_id = request.form['recordId']
+    if not request.form['recordId'].isdigit():
+        return "recordId must be an integer", 400
+    record_id = int(request.form['recordId'])
 
     if file.filename == '':
         return "No selected file", 400
 
-    # Save the file temporarily
-    filename = os.path.join(JOURNEYS_FOLDER, secure_filename(f"{file.filename}"))
-    file.save(filename)
+    try:
+        job_id, cached = enqueue_analysis(record_id, secure_filename(file.filename), file.read())
+    except Exception as e:
+        return f"Error queuing file analysis: {str(e)}", 500
 
-    result = False
+    if cached:
+        return get_job(job_id)
+    return {"jobId": job_id, "status": "queued"}, 202, {"Location": f"/api/analysis_job/{job_id}"}
 
-    # Analyze the file with the algorithm
-    try:
-        result, distance_by_modes = analyse_journey(filename)
-        """
-        The section below will be useful the day you want to calculate CO2e differently depending on the specification (particularly for petrol, diesel, hybrid cars, etc.).
-        It may be necessary to change the structure returned by distance_by_modes to take account of each specification.
-        if you change distance_by_modes, make sure you adapt each location where it was used.
-        """
-        #
-        # file = open(filename, 'r')
-        # try:
-        #     data = json.load(file)
-        # finally:
-        #     journey_data = data.get("journey", [])
-        #     file.close()
+@app.get("/api/analysis_job/<int:job_id>")
+def send_analysis_job(job_id):
+    """
+    API route used to poll the state of a journey analysis.
+    Method:
+        - GET
+    URL parameters:
+        - job_id: ID of the job returned by /api/analyse_journey_file.
+    Possible returns:
+        - 200 (OK): Job state retrieved successfully (queued, running, done or failed).
+        - 404 (Not Found): No job found with the given ID.
+    """
+    return get_job(job_id)
 
-    except Exception as e:
-        app.logger.error(f"Error during file analysis: {str(e)}")
-        # If it fails during the process, set the associated record to rejected
+@app.post("/api/analyse_journey_files")
+def analyse_journey_files():
+    """
+    API route used to analyse many journey files at once, e.g. for a backfill or an offline sync.
+    The files are analysed in parallel and their records updated in a single transaction.
+    Method:
+        - POST
+    Expected multipart form-data request, either:
+        - file: The JSON files containing journey data, repeated.
+        - recordId: The IDs of the journey records, repeated in the same order as the files.
+    or:
+        - archive: A zip archive of JSON files, each named after the ID of its record (e.g. 12.json).
+    Possible returns:
+        - 200 (OK): Files analysed, returns the result of each record.
+        - 400 (Bad Request): No file, files and record IDs not matching, or invalid archive.
+        - 413 (Payload Too Large): Too many files in the batch, or archived files too large once uncompressed.
+        - 500 (Internal Server Error): Error updating the records.
+    """
+    if 'archive' in request.files:
         try:
-            con = database.connect_to_db()
-            cur = con.cursor()
-            cur.execute("UPDATE Records SET isValidated=?, isPending=?, nbMethodUsed=?, kmTravelled=?  WHERE recordId=?", (False, False, len(distance_by_modes), sum(distance_by_modes.values())/1000, record_id))
-            con.commit()
-            con.close()
-        except Exception as e:
-            return f"Error updating record after analysis failure: {str(e)}", 500
-        return "Error during file analysis, record updated with analysis failure", 500
-    finally:
-        # Systematically remove the temporarily stored file from the server
-        os.remove(filename)
+            items = read_journey_archive(request.files['archive'])
+        except JourneyArchiveTooLarge as e:
+            return {"error": str(e)}, 413
+        except ValueError as e:
+            return {"error": str(e)}, 400
+    else:
+        files = request.files.getlist('file')
+        record_ids = request.form.getlist('recordId')
+        if len(files) != len(record_ids) or not all(record_id.isdigit() for record_id in record_ids):
+            return {"error": "Each file needs the ID of its record"}, 400
+        items = [(int(record_id), secure_filename(file.filename), file.read()) for record_id, file in zip(record_ids, files)]
+
     try:
-        # If there was no error, update the record with the result
-        con = database.connect_to_db()
-        cur = con.cursor()
-        cur.execute("UPDATE Records SET isValidated=?, isPending=?, nbMethodUsed=?, kmTravelled=? WHERE recordId=?", (result, False, len(distance_by_modes), sum(distance_by_modes.values())/1000, record_id))
-        con.commit()
-        con.close()
-
-        if result == True:
-            """
-            This section allows you to retrieve a dictionary of CO2e emissions for each transport method and its specifications. It is structured as follows:
-                {
-                    ‘walk’: {‘default’: 0.231},
-                    ‘car‘: {’petrol": 0.634, “diesel”: 0.56, “Unknown”: 0.583},
-                    . . . etc
-                } 
-            """
-            con = database.connect_to_db()
-            cursor = con.cursor()
-
-            # Step 1: Get all carbon emission factors with method names
-            cursor.execute('''
-                SELECT cef.carbonEmissionFactorId, cef.methodId, cef.co2eFactor, m.name AS methodName
-                FROM CarbonEmissionFactors cef
-                JOIN Methods m ON cef.methodId = m.methodId;
-            ''')
-            factors = cursor.fetchall()
-
-            # Step 2: Count the number of factors per method
-            cursor.execute('''
-                SELECT methodId, COUNT(*) AS count
-                FROM CarbonEmissionFactors
-                GROUP BY methodId;
-            ''')
-            counts = cursor.fetchall()
-            method_count = {methodId: count for methodId, count in counts}
-
-            # Step 3: Get specifications for methods with multiple factors
-            cursor.execute('''
-                SELECT cef.carbonEmissionFactorId, cef.methodId, cef.co2eFactor, ms.name AS specificationName
-                FROM CarbonEmissionFactors cef
-                JOIN CarbonEmissionFactorSpecifications ceff ON cef.carbonEmissionFactorId = ceff.carbonEmissionFactorId
-                JOIN MethodsSpecifications ms ON ceff.specificationId = ms.specificationId
-                WHERE ceff.methodId = cef.methodId;
-            ''')
-            specifications = cursor.fetchall()
-
-            con.close()
-
-            emission_dict = {}
-
-            # Process each factor
-            for factorId, methodId, co2eFactor, methodName in factors:
-                methodNameLower = methodName.lower()
-                if method_count[methodId] == 1:
-                    emission_dict[methodNameLower] = {"default": co2eFactor}
-                else:
-                    if methodNameLower not in emission_dict:
-                        emission_dict[methodNameLower] = {}
-
-            # Add specifications to methods with multiple factors
-            for factorId, methodId, co2eFactor, specName in specifications:
-                method_name = next((name for fid, mid, cf, name in factors if fid == factorId), None)
-                if method_name:
-                    methodNameLower = method_name.lower()
-                    emission_dict[methodNameLower][specName.lower()] = co2eFactor
-
-            c02eSaved = calculate_co2e_emission(distance_by_modes, emission_dict, record_id)
-
-            con = database.connect_to_db()
-            cur = con.cursor()
-            cur.execute("UPDATE Records SET co2Saved=? WHERE recordId=?", (c02eSaved, record_id))
-            con.commit()
-            con.close()
-                    
+        return analyse_batch(items)
     except Exception as e:
-        return f"Error updating record: {str(e)}", 500
-
-    return "File successfully analyzed and record updated", 200
+        return {"error": f"Error updating records: {str(e)}"}, 500
 
 @app.post("/api/record")
 def receive_record():
@@ -541,61 +643,18 @@ def get_carbon_emission_stats():
     API route to get carbon emission statistics.
     Method:
         - GET
+    Optional query parameters:
+        - from: First day of the range (YYYY-MM-DD).
+        - to: Last day of the range (YYYY-MM-DD), today by default.
+        - granularity: 'day', 'week' or 'month' (default).
+        Without any of them, returns one value per month of the year, all years combined.
     Possible returns:
         - 200 (OK): Statistics retrieved successfully.
+        - 304 (Not Modified): Statistics unchanged since the ETag sent in If-None-Match.
+        - 400 (Bad Request): Invalid range parameters.
         - 500 (Internal Server Error): Error retrieving statistics.
     """
-    try:
-        con = database.connect_to_db()
-        cur = con.cursor()
-        cur.execute('''
-            SELECT 
-                strftime('%m', c.date) as month,
-                SUM(c.co2eWalk) as co2eWalk,
-                SUM(c.co2eDart) as co2eDart,
-                SUM(c.co2eLuas) as co2eLuas,
-                SUM(c.co2eBike) as co2eBike,
-                SUM(c.co2eCar) as co2eCar,
-                SUM(c.co2eBus) as co2eBus,
-                COUNT(DISTINCT c.recordId) as recordCount
-            FROM 
-                CarbonEmissionStats c
-            JOIN 
-                Records r ON c.recordId = r.recordId
-            WHERE 
-                r.isValidated = 1 AND r.isPending = 0
-            GROUP BY 
-                month
-        ''')
-        rows = cur.fetchall()
-        con.close()
-
-        stats = {
-            "Walk": [0]*12,
-            "Dart": [0]*12,
-            "Luas": [0]*12,
-            "Bike": [0]*12,
-            "Car": [0]*12,
-            "Bus": [0]*12,
-            "TotalRecords": 0,
-        }
-
-        total_records = 0
-        for row in rows:
-            month_index = int(row[0]) - 1
-            stats["Walk"][month_index] = row[1]
-            stats["Dart"][month_index] = row[2]
-            stats["Luas"][month_index] = row[3]
-            stats["Bike"][month_index] = row[4]
-            stats["Car"][month_index] = row[5]
-            stats["Bus"][month_index] = row[6]
-            total_records += row[7]
-
-        stats["TotalRecords"] = total_records
-
-        return jsonify(stats), 200
-    except Exception as e:
-        return str(e), 500
+    return send_stats('get_carbon_emission_stats', 'co2e')
 
 @app.route('/api/kilometers_stats', methods=['GET'])
 def get_kilometers_stats():
@@ -603,61 +662,18 @@ def get_kilometers_stats():
     API route to get kilometers statistics.
     Method:
         - GET
+    Optional query parameters:
+        - from: First day of the range (YYYY-MM-DD).
+        - to: Last day of the range (YYYY-MM-DD), today by default.
+        - granularity: 'day', 'week' or 'month' (default).
+        Without any of them, returns one value per month of the year, all years combined.
     Possible returns:
         - 200 (OK): Statistics retrieved successfully.
+        - 304 (Not Modified): Statistics unchanged since the ETag sent in If-None-Match.
+        - 400 (Bad Request): Invalid range parameters.
         - 500 (Internal Server Error): Error retrieving statistics.
     """
-    try:
-        con = database.connect_to_db()
-        cur = con.cursor()
-        cur.execute('''
-            SELECT 
-                strftime('%m', c.date) as month,
-                SUM(c.kmWalk) as kmWalk,
-                SUM(c.kmDart) as kmDart,
-                SUM(c.kmLuas) as kmLuas,
-                SUM(c.kmBike) as kmBike,
-                SUM(c.kmCar) as kmCar,
-                SUM(c.kmBus) as kmBus,
-                COUNT(DISTINCT c.recordId) as recordCount
-            FROM 
-                CarbonEmissionStats c
-            JOIN 
-                Records r ON c.recordId = r.recordId
-            WHERE 
-                r.isValidated = 1 AND r.isPending = 0
-            GROUP BY 
-                month
-        ''')
-        rows = cur.fetchall()
-        con.close()
-
-        stats = {
-            "Walk": [0]*12,
-            "Dart": [0]*12,
-            "Luas": [0]*12,
-            "Bike": [0]*12,
-            "Car": [0]*12,
-            "Bus": [0]*12,
-            "TotalRecords": 0,
-        }
-
-        total_records = 0
-        for row in rows:
-            month_index = int(row[0]) - 1
-            stats["Walk"][month_index] = row[1]
-            stats["Dart"][month_index] = row[2]
-            stats["Luas"][month_index] = row[3]
-            stats["Bike"][month_index] = row[4]
-            stats["Car"][month_index] = row[5]
-            stats["Bus"][month_index] = row[6]
-            total_records += row[7]
-
-        stats["TotalRecords"] = total_records
-
-        return jsonify(stats), 200
-    except Exception as e:
-        return str(e), 500
+    return send_stats('get_kilometers_stats', 'km')
 
 @app.route('/api/usage_stats', methods=['GET'])
 def get_usage_stats():
@@ -665,61 +681,42 @@ def get_usage_stats():
     API route to get usage statistics.
     Method:
         - GET
+    Optional query parameters:
+        - from: First day of the range (YYYY-MM-DD).
+        - to: Last day of the range (YYYY-MM-DD), today by default.
+        - granularity: 'day', 'week' or 'month' (default).
+        Without any of them, returns one value per month of the year, all years combined.
     Possible returns:
         - 200 (OK): Statistics retrieved successfully.
+        - 304 (Not Modified): Statistics unchanged since the ETag sent in If-None-Match.
+        - 400 (Bad Request): Invalid range parameters.
         - 500 (Internal Server Error): Error retrieving statistics.
     """
-    try:
-        con = database.connect_to_db()
-        cur = con.cursor()
-        cur.execute('''
-            SELECT 
-                strftime('%m', c.date) as month,
-                SUM(CASE WHEN c.isWalkUsed THEN 1 ELSE 0 END) as walkUsage,
-                SUM(CASE WHEN c.isDartUsed THEN 1 ELSE 0 END) as dartUsage,
-                SUM(CASE WHEN c.isLuasUsed THEN 1 ELSE 0 END) as luasUsage,
-                SUM(CASE WHEN c.isBikeUsed THEN 1 ELSE 0 END) as bikeUsage,
-                SUM(CASE WHEN c.isCarUsed THEN 1 ELSE 0 END) as carUsage,
-                SUM(CASE WHEN c.isBusUsed THEN 1 ELSE 0 END) as busUsage,
-                COUNT(DISTINCT c.recordId) as recordCount
-            FROM 
-                CarbonEmissionStats c
-            JOIN 
-                Records r ON c.recordId = r.recordId
-            WHERE 
-                r.isValidated = 1 AND r.isPending = 0
-            GROUP BY 
-                month
-        ''')
-        rows = cur.fetchall()
-        con.close()
-
-        stats = {
-            "Walk": [0]*12,
-            "Dart": [0]*12,
-            "Luas": [0]*12,
-            "Bike": [0]*12,
-            "Car": [0]*12,
-            "Bus": [0]*12,
-            "TotalRecords": 0,
-        }
+    return send_stats('get_usage_stats', 'usage')
 
-        total_records = 0
-        for row in rows:
-            month_index = int(row[0]) - 1
-            stats["Walk"][month_index] = row[1]
-            stats["Dart"][month_index] = row[2]
-            stats["Luas"][month_index] = row[3]
-            stats["Bike"][month_index] = row[4]
-            stats["Car"][month_index] = row[5]
-            stats["Bus"][month_index] = row[6]
-            total_records += row[7]
-
-        stats["TotalRecords"] = total_records
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """
+    Rebuild the monthly statistics rollup from the whole CarbonEmissionStats history.
+    Usage:
+        flask rebuild-stats
+    """
+    rows = rebuild_monthly_stats()
+    print(f"Monthly statistics rebuilt: {rows} rows")
 
-        return jsonify(stats), 200
-    except Exception as e:
-        return str(e), 500
+@app.cli.command("recompute-co2e")
+@click.option("--chunk-size", default=RECOMPUTE_CHUNK_SIZE, show_default=True, help="Rows recomputed per transaction.")
+def recompute_co2e_command(chunk_size):
+    """
+    Recompute the CO2e of every journey with the current emission factors, then rebuild the statistics.
+    Usage:
+        flask recompute-co2e [--chunk-size 5000]
+    """
+    rows, skipped, seconds = recompute_co2e(chunk_size)
+    rate = f", {rows / seconds:.0f} rows/s" if seconds else ""
+    print(f"CO2e recomputed: {rows} rows in {seconds:.2f}s{rate}")
+    if skipped:
+        print(f"Skipped: {skipped} rows whose journey used modes without their own CarbonEmissionStats columns, their CO2e was kept")
 
 # ----------------------------------------------------------------------
 # Weekly Roundup
@@ -737,41 +734,49 @@ def get_weekly_roundup(user_id):
         - 200 (OK): Weekly roundup retrieved successfully.
         - 500 (Internal Server Error): Error retrieving weekly roundup.
     """
-    con = database.connect_to_db()
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    
-    today = datetime.today()
-    start_of_week, end_of_week = get_start_end_of_week(today)
-    start_of_week_str = start_of_week.strftime('%Y-%m-%d')
-    end_of_week_str = end_of_week.strftime('%Y-%m-%d')
-    
-    query = '''
-        SELECT r.*
-        FROM Records r
-        LEFT JOIN Journeys j ON r.journeyId = j.journeyId
-        WHERE j.userId = ?
-          AND r.startDate BETWEEN ? AND ?
-    '''
-    
-    records = cur.execute(query, (user_id, start_of_week_str, end_of_week_str)).fetchall()
-    
-    routes_completed = len(records)
-    co2_reduced = sum(record['co2Saved'] for record in records)
-    
-    cur.close()
-    con.close()
-    
-    data = {
-        'routesCompleted': routes_completed,
-        'co2Reduced': co2_reduced,
-        'pointsEarned': 0,  # To be completed if necessary
-        'moneySaved': 0,    # To be completed if necessary
-        'leaderboardPosition': 0,  # To be completed if necessary
-        'placesGained': 0,   # To be completed if necessary
-    }
-    
-    return jsonify(data)
+    try:
+        return jsonify(build_weekly_roundup(user_id))
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+@app.cli.command("rebuild-weekly-stats")
+def rebuild_weekly_stats_command():
+    """
+    Rebuild the weekly statistics of every user from the validated records.
+    Usage:
+        flask rebuild-weekly-stats
+    """
+    rows = rebuild_weekly_stats()
+    print(f"Weekly statistics rebuilt: {rows} rows")
+
+# ----------------------------------------------------------------------
+# Database
+# ----------------------------------------------------------------------
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """
+    Check that the hot queries use an index, and exit with an error if one scans a whole table.
+    Usage:
+        flask check-query-plans
+    """
+    scans = database.check_query_plans()
+    for name, steps in scans.items():
+        print(f"{name}: {'; '.join(steps)}")
+    if scans:
+        sys.exit(1)
+    print(f"All {len(database.HOT_QUERIES)} hot queries use an index (schema version {database.SCHEMA_VERSION})")
+
+@app.get('/api/db_stats')
+def send_db_stats():
+    """
+    API route used to get the connection pool counters of the serving process.
+    Method:
+        - GET
+    Possible returns:
+        - 200 (OK): Pool hits, misses, returned, discarded and idle connections.
+    """
+    return jsonify(database.pool_stats())
 
 # ----------------------------------------------------------------------
 # App Pages
@@ -803,91 +808,41 @@ def step_app_page():
 # Utility Functions
 # ----------------------------------------------------------------------
 
-def calculate_co2e_emission(distance_by_modes, emission_dict, recordId):
+def send_stats(key, metric):
     """
-    Calculate CO2e emissions for the given distances and update the database.
+    Send the statistics of a metric, for the range given in the query string if any.
     Args:
-        distance_by_modes (dict): Dictionary with distances traveled by each mode.
-        emission_dict (dict): Dictionary with CO2e emission factors for each mode and specification.
-        recordId (int): ID of the record to update.
+        key (str): Name of the route, used as statistics cache key.
+        metric (str): Column to report, 'co2e', 'km' or 'usage'.
     Returns:
-        float: Total CO2e saved.
-    """
-    isWalkUsed = False
-    isDartUsed = False
-    isLuasUsed = False 
-    isBikeUsed = False 
-    isCarUsed = False 
-    isBusUsed = False 
-    kmWalk = 0 
-    kmDart = 0  
-    kmLuas = 0  
-    kmBike = 0 
-    kmCar = 0 
-    kmBus = 0 
-    co2eWalk = 0 
-    co2eDart = 0 
-    co2eLuas = 0 
-    co2eBike = 0 
-    co2eCar = 0 
-    co2eBus = 0 
-
-    for key in distance_by_modes:
-        if key == 'walk':
-            isWalkUsed = True
-            kmWalk += distance_by_modes[key]/1000
-            co2eWalk += distance_by_modes[key]/1000 * emission_dict[key]['default']
-        elif key == 'bus':
-            isBusUsed = True
-            kmBus += distance_by_modes[key]/1000
-            co2eBus += distance_by_modes[key]/1000 * emission_dict[key]['default']
-        elif key == 'luas':
-            isLuasUsed = True
-            kmLuas += distance_by_modes[key]/1000
-            co2eLuas += distance_by_modes[key]/1000 * emission_dict[key]['default']
-        elif key == 'dart':
-            isDartUsed = True
-            kmDart += distance_by_modes[key]/1000
-            co2eDart += distance_by_modes[key]/1000 * emission_dict[key]['default']
-        elif key == 'bike':
-            isBikeUsed = True
-            kmBike += distance_by_modes[key]/1000
-            co2eBike += distance_by_modes[key]/1000 * emission_dict[key]['default']
-        elif key == 'car':
-            isCarUsed = True
-            kmCar += distance_by_modes[key]/1000
-            co2eCar += distance_by_modes[key]/1000 * emission_dict[key]['unknown']
-        
-    con = database.connect_to_db()
-    cur = con.cursor()
-    cur.execute('''
-    INSERT INTO CarbonEmissionStats (
-                recordId, date, isWalkUsed, isDartUsed, isLuasUsed, isBikeUsed, isCarUsed, isBusUsed, kmWalk, kmDart,
-                kmLuas, kmBike, kmCar, kmBus, co2eWalk, co2eDart, co2eLuas, co2eBike, co2eCar, co2eBus) VALUES
-                (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    ''',(recordId, datetime.now(), isWalkUsed, isDartUsed, isLuasUsed, isBikeUsed, isCarUsed, isBusUsed,
-        kmWalk, kmDart, kmLuas, kmBike, kmCar, kmBus, co2eWalk, co2eDart, co2eLuas, co2eBike, co2eCar, co2eBus))
-    con.commit()
-    con.close()
-
-    total_distance = sum(distance_by_modes.values())/1000
-    total_co2e = co2eWalk + co2eDart + co2eLuas + co2eBike + co2eCar + co2eBus
-    co2e_by_car = total_distance * emission_dict['car']['unknown']
-    co2eSaved = co2e_by_car - total_co2e
-
-    return co2eSaved
-
-def get_start_end_of_week(date):
-    """
-    Get the start and end dates of the week for the given date.
+        Response: The statistics response, or an error message and status code.
+    """
+    try:
+        stats_range = parse_stats_range(request.args)
+    except ValueError as e:
+        return str(e), 400
+    try:
+        if stats_range is None:
+            return stats_response(key, lambda: get_monthly_stats(metric))
+        date_from, date_to, granularity = stats_range
+        return stats_response(f"{key}:{date_from}:{date_to}:{granularity}", lambda: get_range_stats(metric, *stats_range))
+    except Exception as e:
+        return str(e), 500
+
+def stats_response(key, build):
+    """
+    Build a cached statistics response supporting conditional requests.
     Args:
-        date (datetime): The date for which to calculate the week start and end.
+        key (str): Name of the response in the statistics cache.
+        build (callable): Function returning the statistics when they are not cached.
     Returns:
-        tuple: Start and end dates of the week.
+        Response: JSON response with an ETag, or 304 (Not Modified) if it matches If-None-Match.
     """
-    start = date - timedelta(days=date.weekday())
-    end = start + timedelta(days=6)
-    return start, end
+    body, etag = get_cached_stats(key, build)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
     app.run(debug=True)
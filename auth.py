@@ -1,6 +1,6 @@
 from users import *
-import os
-from werkzeug.utils import secure_filename
+from images import load_profile_image, save_profile_images
+from sessions import issue_session_token
 
 def login_user(data):
     """
@@ -14,10 +14,9 @@ def login_user(data):
     """
     username = data.get('username')
     password = data.get('password')
-    user = get_user_by_username(username)
-    if user and verify_user(username, password):
-        user_id = str(user[0][0])
-        return {'userId': user_id}, 200
+    user_id = authenticate_user(username, password)
+    if user_id is not None:
+        return {'userId': str(user_id), 'token': issue_session_token(user_id, username)}, 200
     else:
         return {"error": "Invalid credentials"}, 401
 
@@ -66,6 +65,13 @@ def register_user(data, files):
     if existing_user:
         return {"error": "Username already exists"}, 400
 
+    profile_image = None
+    if files.get('profileImage'):
+        try:
+            profile_image = load_profile_image(files['profileImage'].stream)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
     user = create_user({
         'username': username,
         'firstName': first_name,
@@ -84,27 +90,12 @@ def register_user(data, files):
 
     if user:
         user_id = user[0][0]
-        if 'profileImage' in files:
-            save_profile_image(files['profileImage'], user_id)
+        if profile_image is not None:
+            save_profile_images(profile_image, user_id)
         return {"message": "User created successfully", "userId": str(user_id)}, 201
     else:
         return {"error": "Failed to create user"}, 500
     
-def save_profile_image(profile_image, user_id):
-    """
-    Save the profile image for a user.
-
-    Args:
-        profile_image (FileStorage): The profile image file.
-        user_id (int): The ID of the user.
-    """
-    user_pictures_folder = 'user_pictures'
-    if not os.path.exists(user_pictures_folder):
-        os.makedirs(user_pictures_folder)
-    
-    filename = secure_filename(f"{user_id}.png")
-    profile_image.save(os.path.join(user_pictures_folder, filename))
-
 def remove_user(user_id):
     """
     Delete a specific user by user ID.
@@ -1,19 +1,568 @@
+import functools
+import os
+import queue
+import random
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+# Path of the STEP SQLite database
+DATABASE_PATH = '../../db/step-db/stepdb.db'
+
+# The maximum number of idle connections kept by the pool of each process
+POOL_SIZE = 8
+
+# Database profile: pragmas applied once to every new connection before it enters the pool.
+# WAL lets readers run alongside a writer, and busy_timeout makes SQLite wait for the write
+# lock held by another Gunicorn worker instead of failing straight away with "database is locked".
+DB_PROFILE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,             # milliseconds
+    "cache_size": -16000,             # negative values are in KiB, so 16 MB of page cache
+    "mmap_size": 128 * 1024 * 1024,   # bytes
+    "temp_store": "MEMORY",
+}
+
+# How many times a write is retried when the database stays locked past busy_timeout
+WRITE_RETRIES = 5
+
+# Initial delay in seconds between two write attempts, doubled after each attempt
+WRITE_RETRY_DELAY = 0.05
+
+def backfill_monthly_stats(con):
+    """
+    Migration step filling the new monthly rollup from the existing CarbonEmissionStats rows.
+
+    Args:
+        con (sqlite3.Connection): Connection running the migration.
+    """
+    # Imported here, the statistics modules import this one
+    from emissions import get_emission_stats_modes
+    from stats import monthly_stats_query
+    con.execute(f"INSERT INTO MonthlyStats (year, month, mode, km, co2e, usage) {monthly_stats_query(get_emission_stats_modes(con.cursor()))}")
+
+def backfill_weekly_stats(con):
+    """
+    Migration step filling the new weekly user statistics from the existing records.
+
+    Args:
+        con (sqlite3.Connection): Connection running the migration.
+    """
+    # Imported here, the statistics modules import this one
+    from roundup import weekly_stats_query
+    con.execute(f"INSERT INTO WeeklyUserStats (weekStart, userId, routesCompleted, co2Saved, points) {weekly_stats_query()}")
+
+# Schema migrations applied in order by migrate(): (description, statements), each statement
+# being SQL or a function called with the connection. Never edit a released migration,
+# append a new one instead.
+MIGRATIONS = [
+    ("Analysis job queue", [
+        '''
+        CREATE TABLE IF NOT EXISTS AnalysisJobs (
+            jobId INTEGER PRIMARY KEY AUTOINCREMENT,
+            recordId INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            trace BLOB,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result INTEGER,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            createdAt TEXT NOT NULL,
+            startedAt TEXT,
+            finishedAt TEXT
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON AnalysisJobs(status, startedAt)",
+    ]),
+    ("Monthly statistics rollup and cache versions", [
+        '''
+        CREATE TABLE IF NOT EXISTS MonthlyStats (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            mode TEXT NOT NULL,
+            km REAL NOT NULL DEFAULT 0,
+            co2e REAL NOT NULL DEFAULT 0,
+            usage INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (year, month, mode)
+        ) WITHOUT ROWID
+        ''',
+        backfill_monthly_stats,
+        '''
+        CREATE TABLE IF NOT EXISTS CacheVersions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    ("Statistics date range indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_carbon_emission_stats_date ON CarbonEmissionStats(date)",
+        "CREATE INDEX IF NOT EXISTS idx_records_status ON Records(isValidated, isPending)",
+    ]),
+    ("Hot lookup indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_journeys_user ON Journeys(userId)",
+        "CREATE INDEX IF NOT EXISTS idx_records_journey ON Records(journeyId, startDate)",
+        "CREATE INDEX IF NOT EXISTS idx_records_start_date ON Records(startDate)",
+        "CREATE INDEX IF NOT EXISTS idx_methods_specifications_method ON MethodsSpecifications(methodId)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON Users(username)",
+        "CREATE INDEX IF NOT EXISTS idx_carbon_emission_stats_record ON CarbonEmissionStats(recordId)",
+    ]),
+    ("Weekly user statistics and leaderboard", [
+        '''
+        CREATE TABLE IF NOT EXISTS WeeklyUserStats (
+            weekStart TEXT NOT NULL,
+            userId INTEGER NOT NULL,
+            routesCompleted INTEGER NOT NULL DEFAULT 0,
+            co2Saved REAL NOT NULL DEFAULT 0,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (weekStart, userId)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_weekly_user_stats_rank ON WeeklyUserStats(weekStart, co2Saved)",
+        backfill_weekly_stats,
+    ]),
+    ("Journey file manifest", [
+        '''
+        CREATE TABLE IF NOT EXISTS JourneyFiles (
+            filename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            modes TEXT NOT NULL,
+            createdAt TEXT NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_journey_files_created ON JourneyFiles(createdAt, filename)",
+        '''
+        CREATE TABLE IF NOT EXISTS JourneyFileCounts (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            count INTEGER NOT NULL,
+            totalSize INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO JourneyFileCounts (id, count, totalSize) VALUES (1, 0, 0)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_journey_files_insert AFTER INSERT ON JourneyFiles
+        BEGIN
+            UPDATE JourneyFileCounts SET count = count + 1, totalSize = totalSize + NEW.size WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_journey_files_update AFTER UPDATE OF size ON JourneyFiles
+        BEGIN
+            UPDATE JourneyFileCounts SET totalSize = totalSize - OLD.size + NEW.size WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_journey_files_delete AFTER DELETE ON JourneyFiles
+        BEGIN
+            UPDATE JourneyFileCounts SET count = count - 1, totalSize = totalSize - OLD.size WHERE id = 1;
+        END
+        ''',
+    ]),
+    ("Analysis result cache", [
+        '''
+        CREATE TABLE IF NOT EXISTS AnalysisCache (
+            digest TEXT PRIMARY KEY,
+            result INTEGER NOT NULL,
+            distanceByModes TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            createdAt TEXT NOT NULL,
+            lastUsedAt TEXT NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON AnalysisCache(lastUsedAt)",
+    ]),
+    ("User profile cache versions", [
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_profile_update AFTER UPDATE ON Users
+        BEGIN
+            INSERT INTO CacheVersions (name, version) VALUES ('user:' || NEW.userId, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_profile_delete AFTER DELETE ON Users
+        BEGIN
+            INSERT INTO CacheVersions (name, version) VALUES ('user:' || OLD.userId, 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        ''',
+    ] + [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_profiles_update AFTER UPDATE ON {table}
+        BEGIN
+            INSERT INTO CacheVersions (name, version) VALUES ('profiles', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        ''' for table in ("Companies", "CompanyPositions", "Rewards")
+    ]),
+    ("Emission factor cache versions", [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_emission_factors_{event.lower()} AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO CacheVersions (name, version) VALUES ('emission factors', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        ''' for table in ("CarbonEmissionFactors", "CarbonEmissionFactorSpecifications", "Methods", "MethodsSpecifications")
+            for event in ("INSERT", "UPDATE", "DELETE")
+    ]),
+    ("User profile cache versions on inserts and deletes", [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_profiles_{event.lower()} AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO CacheVersions (name, version) VALUES ('profiles', 1)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1;
+        END
+        ''' for table in ("Companies", "CompanyPositions", "Rewards") for event in ("INSERT", "DELETE")
+    ]),
+]
+
+# Version of the schema expected by this server
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Queries on the hot paths, checked by check_query_plans(): name -> (query, example parameters)
+HOT_QUERIES = {
+    "user journeys": ("SELECT * FROM Journeys WHERE userId=?", (1,)),
+    "user records": ('''
+        SELECT r.*, j.name as journey_name
+        FROM Records r
+        LEFT JOIN Journeys j ON r.journeyId = j.journeyId
+        WHERE j.userId = ?
+        ORDER BY r.startDate DESC
+    ''', (1,)),
+    "user records page": ('''
+        SELECT r.recordId, j.name, r.startDate
+        FROM Journeys j
+        JOIN Records r ON r.recordId IN (
+            SELECT recordId FROM Records
+            WHERE journeyId = j.journeyId AND startDate IS NOT NULL AND (startDate, recordId) < (?, ?)
+            ORDER BY startDate DESC, recordId DESC LIMIT ?
+        )
+        WHERE j.userId = ?
+        ORDER BY r.startDate DESC, r.recordId DESC LIMIT ?
+    ''', ("2024-07-01", 1, 51, 1, 51)),
+    "user undated records page": ('''
+        SELECT r.recordId, j.name, r.startDate
+        FROM Journeys j
+        JOIN Records r ON r.recordId IN (
+            SELECT recordId FROM Records
+            WHERE journeyId = j.journeyId AND startDate IS NULL AND recordId < ?
+            ORDER BY recordId DESC LIMIT ?
+        )
+        WHERE j.userId = ?
+        ORDER BY r.recordId DESC LIMIT ?
+    ''', (1, 51, 1, 51)),
+    "weekly roundup": ("SELECT routesCompleted, co2Saved, points FROM WeeklyUserStats WHERE weekStart=? AND userId=?", ("2024-07-01", 1)),
+    "leaderboard position": ("SELECT COUNT(*) FROM WeeklyUserStats WHERE weekStart=? AND co2Saved > ?", ("2024-07-01", 1.5)),
+    "method specifications": ("SELECT * FROM MethodsSpecifications WHERE methodId=?", (1,)),
+    "user by username": ("SELECT * FROM Users WHERE username=?", ("username",)),
+    "analysis cache": ("SELECT digest, result, distanceByModes FROM AnalysisCache WHERE digest IN (SELECT value FROM json_each(?))", ('["' + "0" * 64 + '"]',)),
+    "analysis cache eviction": ("SELECT digest FROM AnalysisCache ORDER BY lastUsedAt LIMIT ?", (1,)),
+    "record emission stats": ("SELECT * FROM CarbonEmissionStats WHERE recordId=?", (1,)),
+    "statistics range": ('''
+        SELECT COUNT(*)
+        FROM CarbonEmissionStats c
+        JOIN Records r ON c.recordId = r.recordId
+        WHERE c.date >= ? AND c.date < ?
+          AND r.isValidated = 1 AND r.isPending = 0
+    ''', ("2024-01-01", "2024-02-01")),
+}
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_pool_pid = os.getpid()
+_pool_lock = threading.Lock()
+_pool_stats = {"hits": 0, "misses": 0, "returned": 0, "discarded": 0}
+_local = threading.local()
 
 def connect_to_db():
     """
     SQLite Database Connection
 
     This module establishes a connection to an SQLite database using the 'sqlite3' interface.
+    Connections returned by this function are not pooled, use get_db() inside the application.
 
     Functions:
-        - connect_to_db(): Establishes a connection to the database.
+        - connect_to_db(): Establishes a new connection to the database with DB_PROFILE applied.
+        - get_db(): Returns the pooled connection of the current request or thread.
+        - pool_stats(): Returns the hit/miss counters of the connection pool.
 
     Dependencies:
         - sqlite3: Python interface for SQLite.
     """
     try:
-        con = sqlite3.connect('../../db/step-db/stepdb.db')
+        con = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        for name, value in DB_PROFILE.items():
+            con.execute(f"PRAGMA {name}={value}")
         return con
     except sqlite3.Error as er:
-        raise Exception(f"Failed to connect to the database. Error code: {er.sqlite_errorcode}, Error message: {er.sqlite_errorname}")
\ No newline at end of file
+        raise Exception(f"Failed to connect to the database. Error code: {er.sqlite_errorcode}, Error message: {er.sqlite_errorname}")
+
+def _reset_pool_after_fork():
+    """
+    Drop the pool inherited from a parent process.
+
+    SQLite connections must not be shared across a fork (Gunicorn workers, process pools),
+    so each process starts with its own empty pool and counters.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool = queue.LifoQueue(maxsize=POOL_SIZE)
+            _pool_pid = os.getpid()
+            for key in _pool_stats:
+                _pool_stats[key] = 0
+
+def _count(event):
+    with _pool_lock:
+        _pool_stats[event] += 1
+
+def acquire_connection():
+    """
+    Take an idle connection from the pool, or open a new one if the pool is empty.
+
+    Returns:
+        sqlite3.Connection: A connection with DB_PROFILE already applied.
+    """
+    if _pool_pid != os.getpid():
+        _reset_pool_after_fork()
+    try:
+        con = _pool.get_nowait()
+    except queue.Empty:
+        _count("misses")
+        return connect_to_db()
+    _count("hits")
+    return con
+
+def release_connection(con):
+    """
+    Give a connection back to the pool.
+
+    Any transaction left open is rolled back so the next user gets a clean connection.
+    The connection is closed instead when the pool is full or the connection is broken.
+
+    Args:
+        con (sqlite3.Connection): Connection obtained from acquire_connection().
+    """
+    if con is None:
+        return
+    try:
+        if con.in_transaction:
+            con.rollback()
+        con.row_factory = None
+        if _pool_pid != os.getpid():
+            raise queue.Full
+        _pool.put_nowait(con)
+        _count("returned")
+    except (queue.Full, sqlite3.Error):
+        con.close()
+        _count("discarded")
+
+def get_db():
+    """
+    Get the connection of the current request.
+
+    Inside a Flask application context the same pooled connection is reused for the
+    whole request and released by close_db() on teardown. Outside of it (CLI commands,
+    background workers) each thread keeps its own pooled connection.
+
+    Returns:
+        sqlite3.Connection: The connection to use for the current request or thread.
+    """
+    if has_app_context():
+        if "_database" not in g:
+            g._database = acquire_connection()
+        return g._database
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.con = acquire_connection()
+        _local.pid = os.getpid()
+    return _local.con
+
+def close_db(exception=None):
+    """
+    Release the connection of the current application context back to the pool.
+
+    Args:
+        exception (Exception): Exception raised during the request, if any.
+    """
+    release_connection(g.pop("_database", None))
+
+def pool_stats():
+    """
+    Get the counters of the connection pool of the current process.
+
+    Returns:
+        dict: Pool hits, misses, returned and discarded connections, and idle connections.
+    """
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    stats["idle"] = _pool.qsize() if _pool_pid == os.getpid() else 0
+    stats["size"] = POOL_SIZE
+    return stats
+
+def configure(path=None, profile=None):
+    """
+    Change the database path or profile.
+
+    Idle connections opened with the previous settings are closed, so every connection
+    handed out afterwards uses the new ones.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        profile (dict): Pragmas overriding the matching entries of DB_PROFILE.
+    """
+    global DATABASE_PATH
+    if path:
+        DATABASE_PATH = path
+    if profile:
+        DB_PROFILE.update(profile)
+    while True:
+        try:
+            con = _pool.get_nowait()
+        except queue.Empty:
+            break
+        con.close()
+
+def is_locked_error(er):
+    """
+    Check whether an SQLite error is a transient lock conflict with another connection.
+
+    Args:
+        er (sqlite3.Error): The error raised by SQLite.
+
+    Returns:
+        bool: True if the operation can be retried later, otherwise False.
+    """
+    message = str(er).lower()
+    return isinstance(er, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+def retry_on_locked(func):
+    """
+    Decorator retrying a write with exponential backoff while the database is locked.
+
+    The open transaction is rolled back before each new attempt, so the decorated function
+    must own its whole transaction and be safe to run again from the start.
+
+    Args:
+        func (callable): Function performing the write and its commit.
+
+    Returns:
+        callable: The wrapped function.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = WRITE_RETRY_DELAY
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as er:
+                if attempt == WRITE_RETRIES or not is_locked_error(er):
+                    raise
+                con = get_db()
+                if con.in_transaction:
+                    con.rollback()
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay *= 2
+    return wrapper
+
+@contextmanager
+def transaction():
+    """
+    Run a block of writes in a single transaction on the connection of the current request.
+
+    The write lock is taken up front with BEGIN IMMEDIATE, so a conflict with another worker
+    is reported (and retried by retry_on_locked) before any work is done, rather than when
+    upgrading a read transaction. When a transaction is already open, the block joins it.
+
+    Yields:
+        sqlite3.Cursor: Cursor to run the statements with.
+    """
+    con = get_db()
+    if con.in_transaction:
+        yield con.cursor()
+        return
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con.cursor()
+    except BaseException:
+        con.rollback()
+        raise
+    con.commit()
+
+def migrate():
+    """
+    Bring the database schema up to SCHEMA_VERSION.
+
+    The version of the database is stored in PRAGMA user_version, and each missing
+    migration is applied in its own transaction along with the new version number.
+    The write lock is taken before reading the version, so several workers starting
+    at the same time apply each migration only once.
+
+    Returns:
+        int: Version of the database schema.
+
+    Raises:
+        RuntimeError: The database is newer than this server, or a migration failed.
+    """
+    con = connect_to_db()
+    try:
+        while True:
+            con.execute("BEGIN IMMEDIATE")
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                con.rollback()
+                raise RuntimeError(f"Database schema version {version} is newer than the version {SCHEMA_VERSION} supported by this server")
+            if version == SCHEMA_VERSION:
+                con.rollback()
+                return version
+            description, statements = MIGRATIONS[version]
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(con)
+                    else:
+                        con.execute(statement)
+                con.execute(f"PRAGMA user_version = {version + 1}")
+                con.commit()
+            except sqlite3.Error as er:
+                con.rollback()
+                raise RuntimeError(f"Database migration {version + 1} ({description}) failed: {er}") from er
+    finally:
+        con.close()
+
+def check_query_plans():
+    """
+    Run EXPLAIN QUERY PLAN on the hot queries and find the ones scanning a whole table.
+
+    Returns:
+        dict: Plan steps scanning a table, by query name. Empty when every query uses an index.
+    """
+    con = connect_to_db()
+    try:
+        scans = {}
+        for name, (query, params) in HOT_QUERIES.items():
+            plan = [row[3] for row in con.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+            full_scans = [step for step in plan if step.startswith("SCAN") and "USING" not in step and "VIRTUAL TABLE" not in step]
+            if full_scans:
+                scans[name] = full_scans
+        return scans
+    finally:
+        con.close()
+
+def init_app(app):
+    """
+    Apply the database configuration of the Flask application, migrate the schema
+    and register the teardown handler.
+
+    The 'DATABASE_PATH' and 'DATABASE_PROFILE' config keys (or the STEP_DB_PATH environment
+    variable) override the module defaults.
+
+    Startup fails with a RuntimeError when the schema cannot be brought to SCHEMA_VERSION.
+
+    Args:
+        app (Flask): The Flask application.
+    """
+    configure(app.config.get('DATABASE_PATH', os.environ.get('STEP_DB_PATH')), app.config.get('DATABASE_PROFILE'))
+    migrate()
+    app.teardown_appcontext(close_db)
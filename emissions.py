@@ -0,0 +1,136 @@
+import json
+
+import numpy as np
+
+# Specification of the methods with a single CO2e emission factor
+DEFAULT_SPECIFICATION = "default"
+
+# Specification used for a method with several factors when the journey does not name one of them
+UNKNOWN_SPECIFICATION = "unknown"
+
+# Factor the CO2e saved by a journey is measured against: the same distance by car
+REFERENCE_FACTOR = ("car", UNKNOWN_SPECIFICATION)
+
+class Co2eCalculator:
+    """
+    Table-driven CO2e calculator.
+
+    The factors of every method and specification are laid out in a single vector, and each
+    (record, mode) cell of a batch points to its factor in that vector, so the kilometers and
+    CO2e of every mode of every record are computed in one NumPy pass. Modes and specifications
+    only exist as data: a factor added to the database is used without any code change, and a
+    mode without a factor counts in the distance with no emission.
+    """
+
+    def __init__(self, emission_dict):
+        """
+        Args:
+            emission_dict (dict): CO2e emission factors by method and specification, e.g. {'walk': {'default': 0.231}, 'car': {'petrol': 0.634, 'diesel': 0.56}}.
+        """
+        self.factor_index = {}
+        factors = []
+        for method, specifications in emission_dict.items():
+            for specification, factor in specifications.items():
+                self.factor_index[(method, specification)] = len(factors)
+                factors.append(factor)
+        # The last factor is used by the modes without one
+        self.no_factor = len(factors)
+        self.factors = np.array(factors + [0.0], dtype=float)
+        self.reference = emission_dict[REFERENCE_FACTOR[0]][REFERENCE_FACTOR[1]]
+
+    def factor_column(self, mode, specifications=()):
+        """
+        Find the factor of a mode for a journey.
+
+        Args:
+            mode (str): Name of the mode in lower case, e.g. 'car'.
+            specifications (list): Names of the specifications chosen for this mode in the journey, in lower case.
+
+        Returns:
+            int: Position of the factor in the factor vector.
+        """
+        for specification in (*specifications, DEFAULT_SPECIFICATION, UNKNOWN_SPECIFICATION):
+            column = self.factor_index.get((mode, specification))
+            if column is not None:
+                return column
+        return self.no_factor
+
+    def calculate(self, km, factor_columns):
+        """
+        Calculate the CO2e emitted and saved by a batch of records.
+
+        Args:
+            km (np.ndarray): Kilometers travelled, one row per record and one column per mode.
+            factor_columns (np.ndarray): Position of the factor of each cell of km in the factor vector.
+
+        Returns:
+            tuple: CO2e emitted by each mode of each record, and total CO2e saved by each record compared to the same distance by car.
+        """
+        co2e = km * self.factors[factor_columns]
+        co2e_saved = km.sum(axis=1) * self.reference - co2e.sum(axis=1)
+        return co2e, co2e_saved
+
+    def calculate_records(self, distances, specifications=None):
+        """
+        Calculate the kilometers and CO2e of each mode for a batch of analysed journeys.
+
+        Args:
+            distances (list): Distance travelled by each mode in meters, one dictionary per record.
+            specifications (list): Specifications chosen for each mode, one dictionary per record as returned by journey_specifications().
+
+        Returns:
+            tuple: Modes in lower case, then kilometers, CO2e and whether each mode was used as arrays
+            with one row per record and one column per mode, and the CO2e saved by each record.
+        """
+        specifications = specifications or [{}] * len(distances)
+        modes = sorted({mode.lower() for distance_by_modes in distances for mode in distance_by_modes})
+        mode_index = {mode: index for index, mode in enumerate(modes)}
+
+        km = np.zeros((len(distances), len(modes)))
+        used = np.zeros((len(distances), len(modes)), dtype=bool)
+        factor_columns = np.full((len(distances), len(modes)), self.no_factor)
+        for row, (distance_by_modes, record_specifications) in enumerate(zip(distances, specifications)):
+            for mode, distance in distance_by_modes.items():
+                mode = mode.lower()
+                column = mode_index[mode]
+                km[row, column] += distance
+                used[row, column] = True
+                factor_columns[row, column] = self.factor_column(mode, record_specifications.get(mode, ()))
+        km /= 1000
+
+        co2e, co2e_saved = self.calculate(km, factor_columns)
+        return modes, km, co2e, used, co2e_saved
+
+def journey_specifications(methods_json):
+    """
+    Get the specifications chosen for each method of a journey.
+
+    Args:
+        methods_json (str): Journeys.methodsJson, e.g. '{"journey": [{"method": {"name": "Car"}, "methodSpecifications": [{"name": "Diesel"}]}]}'.
+
+    Returns:
+        dict: Names of the specifications of each method, both in lower case.
+    """
+    try:
+        steps = json.loads(methods_json)["journey"]
+        specifications = {}
+        for step in steps:
+            names = specifications.setdefault(step["method"]["name"].lower(), [])
+            names.extend(specification["name"].lower() for specification in step.get("methodSpecifications") or [])
+        return specifications
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return {}
+
+def get_emission_stats_modes(cur):
+    """
+    Get the modes with their own columns in CarbonEmissionStats (kmWalk, co2eWalk, isWalkUsed, ...).
+
+    Args:
+        cur (sqlite3.Cursor): Cursor to read the table definition with.
+
+    Returns:
+        list: Names of the modes as written in the columns, e.g. 'Walk', in the order of the columns.
+    """
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(CarbonEmissionStats)")]
+    modes = [column[len("km"):] for column in columns if column.startswith("km")]
+    return [mode for mode in modes if f"co2e{mode}" in columns and f"is{mode}Used" in columns]
@@ -0,0 +1,187 @@
+import hashlib, io, os, threading
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Folder of the profile pictures, named after the ID of their user
+USER_PICTURES_FOLDER = 'user_pictures'
+
+# Variants stored for each profile picture: name -> side of the square image in pixels
+PROFILE_IMAGE_SIZES = {"small": 64, "medium": 256, "large": 512}
+
+# Variant served when the request does not ask for a size
+DEFAULT_PROFILE_IMAGE_SIZE = "large"
+
+# WebP quality of the variants, from 0 to 100
+PROFILE_IMAGE_QUALITY = 80
+
+# Uploads with more pixels than this are rejected before being decoded
+PROFILE_IMAGE_MAX_PIXELS = 50_000_000
+
+# The time clients may reuse a profile picture before checking its ETag again, in seconds
+PROFILE_IMAGE_MAX_AGE = 3600
+
+# ETags of the served files: path -> (modification time, size, ETag)
+_etag_cache = {}
+_etag_cache_lock = threading.Lock()
+
+def profile_image_path(user_id, size):
+    """
+    Get the path of a variant of the profile picture of a user.
+
+    Args:
+        user_id (int): ID of the user.
+        size (str): Name of the variant, among PROFILE_IMAGE_SIZES.
+
+    Returns:
+        str: Path of the WebP file.
+    """
+    return os.path.join(USER_PICTURES_FOLDER, f"{user_id}_{size}.webp")
+
+def legacy_profile_image_path(user_id):
+    """
+    Get the path of a profile picture stored as uploaded, before the variants existed.
+
+    Args:
+        user_id (int): ID of the user.
+
+    Returns:
+        str: Path of the PNG file.
+    """
+    return os.path.join(USER_PICTURES_FOLDER, f"{user_id}.png")
+
+def load_profile_image(stream):
+    """
+    Decode an uploaded profile picture and crop it to a square.
+
+    JPEG uploads are decoded directly at the smallest scale that still covers the largest
+    variant, so a photo straight from a phone camera is never decoded at full resolution.
+
+    Args:
+        stream (file): Uploaded image, in any format supported by Pillow.
+
+    Returns:
+        PIL.Image.Image: Upright square image, no larger than the largest variant.
+
+    Raises:
+        ValueError: The upload is not an image, or it is too large.
+    """
+    largest = max(PROFILE_IMAGE_SIZES.values())
+    try:
+        image = Image.open(stream)
+        if image.width * image.height > PROFILE_IMAGE_MAX_PIXELS:
+            raise ValueError("Profile image is too large")
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise ValueError("Invalid profile image")
+    side = min(image.width, image.height, largest)
+    return ImageOps.fit(image, (side, side), Image.LANCZOS)
+
+def save_profile_images(image, user_id):
+    """
+    Store the variants of the profile picture of a user, replacing the previous ones.
+
+    Each file is written next to its final path and then renamed, so a request never
+    reads a partially written picture.
+
+    Args:
+        image (PIL.Image.Image): Square image returned by load_profile_image().
+        user_id (int): ID of the user.
+    """
+    os.makedirs(USER_PICTURES_FOLDER, exist_ok=True)
+    for size, side in PROFILE_IMAGE_SIZES.items():
+        variant = image.resize((side, side), Image.LANCZOS) if image.width > side else image
+        buffer = io.BytesIO()
+        variant.save(buffer, "WEBP", quality=PROFILE_IMAGE_QUALITY, method=6)
+        path = profile_image_path(user_id, size)
+        with open(path + ".tmp", 'wb') as file:
+            file.write(buffer.getvalue())
+        os.replace(path + ".tmp", path)
+    try:
+        os.remove(legacy_profile_image_path(user_id))
+    except FileNotFoundError:
+        pass
+
+def remove_profile_images(user_id):
+    """
+    Delete every stored variant of the profile picture of a user.
+
+    Args:
+        user_id (int): ID of the user.
+    """
+    paths = [profile_image_path(user_id, size) for size in PROFILE_IMAGE_SIZES]
+    for path in paths + [legacy_profile_image_path(user_id)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def find_profile_image(user_id, size=DEFAULT_PROFILE_IMAGE_SIZE):
+    """
+    Find the file to serve for the profile picture of a user.
+
+    Args:
+        user_id (int): ID of the user.
+        size (str): Name of the variant, among PROFILE_IMAGE_SIZES.
+
+    Returns:
+        tuple: Path and MIME type of the file, or None if the user has no profile picture.
+    """
+    path = profile_image_path(user_id, size)
+    if os.path.exists(path):
+        return path, "image/webp"
+    path = legacy_profile_image_path(user_id)
+    if os.path.exists(path):
+        return path, "image/png"
+    return None
+
+def get_profile_image_etag(path):
+    """
+    Get the strong ETag of a profile picture file.
+
+    The ETag is the hash of the content of the file, so it is the same in every worker,
+    and it is only computed again when the file is replaced.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: ETag of the file, without quotes.
+    """
+    stat = os.stat(path)
+    with _etag_cache_lock:
+        entry = _etag_cache.get(path)
+    if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+        return entry[2]
+    with open(path, 'rb') as file:
+        etag = hashlib.sha256(file.read()).hexdigest()[:32]
+    with _etag_cache_lock:
+        _etag_cache[path] = (stat.st_mtime_ns, stat.st_size, etag)
+    return etag
+
+def convert_profile_images():
+    """
+    Store the variants of every profile picture still stored as uploaded, then remove the originals.
+
+    Returns:
+        tuple: Number of pictures converted, and names of the files that are not valid images and were kept.
+    """
+    if not os.path.isdir(USER_PICTURES_FOLDER):
+        return 0, []
+    converted = 0
+    invalid = []
+    for entry in os.scandir(USER_PICTURES_FOLDER):
+        user_id, extension = os.path.splitext(entry.name)
+        if extension != ".png" or not user_id.isdigit():
+            continue
+        try:
+            with open(entry.path, 'rb') as file:
+                image = load_profile_image(file)
+        except ValueError:
+            invalid.append(entry.name)
+            continue
+        save_profile_images(image, int(user_id))
+        converted += 1
+    return converted, invalid
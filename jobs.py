@@ -0,0 +1,309 @@
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import database
+from analysis import analyse_and_cache_trace, finalise_record, finalise_records, get_cached_analyses, get_cached_analysis, trace_digest
+
+# The number of processes analysing journeys in the background
+ANALYSIS_WORKERS = 2
+
+# The time after which a job still marked as running is considered lost and queued again
+JOB_LEASE = timedelta(minutes=10)
+
+# The maximum number of journey files analysed by a single batch request
+MAX_BATCH_SIZE = 500
+
+# The maximum uncompressed size of a journey file in a batch archive, in bytes
+MAX_ARCHIVE_ENTRY_SIZE = 16 * 1024 * 1024
+
+# The maximum uncompressed size of all the journey files of a batch archive, in bytes
+MAX_ARCHIVE_SIZE = 64 * 1024 * 1024
+
+_executor = None
+
+def get_executor():
+    """
+    Get the process pool running the analysis jobs, creating it on first use.
+
+    Workers are spawned rather than forked so they do not inherit the threads and open
+    connections of the web server, and are configured with the same database settings.
+
+    Returns:
+        ProcessPoolExecutor: The analysis process pool.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=ANALYSIS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=database.configure,
+            initargs=(database.DATABASE_PATH, dict(database.DB_PROFILE)),
+        )
+    return _executor
+
+@database.retry_on_locked
+def create_job(record_id, filename, trace):
+    """
+    Store a journey trace in the job queue.
+
+    Args:
+        record_id (int): ID of the record the trace belongs to.
+        filename (str): Secure name of the uploaded file.
+        trace (bytes | memoryview): Content of the uploaded journey file, None for a job already running.
+
+    Returns:
+        int: ID of the created job.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    now = datetime.now().isoformat()
+    if trace is None:
+        cur.execute("INSERT INTO AnalysisJobs (recordId, filename, status, attempts, createdAt, startedAt) VALUES (?, ?, 'running', 1, ?, ?)", (record_id, filename, now, now))
+    else:
+        cur.execute("INSERT INTO AnalysisJobs (recordId, filename, trace, createdAt) VALUES (?, ?, ?, ?)", (record_id, filename, trace, now))
+    con.commit()
+    return cur.lastrowid
+
+def enqueue_analysis(record_id, filename, trace):
+    """
+    Queue the analysis of a journey trace.
+
+    A trace analysed before is not queued: its stored result is applied to the record
+    straight away and the job is created already finished.
+
+    Args:
+        record_id (int): ID of the record the trace belongs to.
+        filename (str): Secure name of the uploaded file.
+        trace (bytes | memoryview): Content of the uploaded journey file.
+
+    Returns:
+        tuple: ID of the created job, and whether it was finished from the analysis cache.
+    """
+    cached = get_cached_analysis(trace_digest(trace))
+    if cached is not None:
+        job_id = create_job(record_id, filename, None)
+        complete_job(job_id, record_id, *cached)
+        return job_id, True
+    job_id = create_job(record_id, filename, trace)
+    get_executor().submit(run_analysis_job, job_id)
+    return job_id, False
+
+@database.retry_on_locked
+def claim_job(job_id):
+    """
+    Move a queued job to the running state.
+
+    Several web workers may submit the same job after a restart, only the first claim succeeds.
+
+    Args:
+        job_id (int): ID of the job.
+
+    Returns:
+        tuple: Record ID, filename and trace of the job, or None if it was already claimed.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    cur.execute("UPDATE AnalysisJobs SET status='running', attempts=attempts+1, startedAt=? WHERE jobId=? AND status='queued'", (datetime.now().isoformat(), job_id))
+    con.commit()
+    if cur.rowcount == 0:
+        return None
+    return cur.execute("SELECT recordId, filename, trace FROM AnalysisJobs WHERE jobId=?", (job_id,)).fetchone()
+
+@database.retry_on_locked
+def finish_job(job_id, status, result=None, error=None):
+    """
+    Store the final state of a job and drop its trace.
+
+    Args:
+        job_id (int): ID of the job.
+        status (str): 'done' or 'failed'.
+        result (bool): Whether the journey was validated.
+        error (str): Error message of a failed job.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    cur.execute("UPDATE AnalysisJobs SET status=?, result=?, error=?, trace=NULL, finishedAt=? WHERE jobId=?", (status, result, error, datetime.now().isoformat(), job_id))
+    con.commit()
+
+def run_analysis_job(job_id):
+    """
+    Analyse the trace of a job and update its record. Runs inside the process pool.
+
+    Args:
+        job_id (int): ID of the job.
+    """
+    job = claim_job(job_id)
+    if job is None:
+        return
+    record_id, filename, trace = job
+    try:
+        result, distance_by_modes = analyse_and_cache_trace(trace, filename)
+    except Exception as e:
+        # If it fails during the process, set the associated record to rejected
+        finalise_record(record_id, False, {})
+        finish_job(job_id, 'failed', error=f"Error during file analysis: {str(e)}")
+        return
+    complete_job(job_id, record_id, result, distance_by_modes)
+
+def complete_job(job_id, record_id, result, distance_by_modes):
+    """
+    Apply the result of an analysis to its record and finish the job.
+
+    The job fails when the record was not pending anymore, since the result was not applied.
+
+    Args:
+        job_id (int): ID of the job.
+        record_id (int): ID of the record.
+        result (bool): Whether the journey is validated.
+        distance_by_modes (dict): Distance travelled by each mode in meters.
+    """
+    try:
+        finalised = finalise_record(record_id, result, distance_by_modes)
+    except Exception as e:
+        finish_job(job_id, 'failed', result=result, error=f"Error updating record: {str(e)}")
+        return
+    if not finalised:
+        finish_job(job_id, 'failed', result=result, error="Record already finalised")
+        return
+    finish_job(job_id, 'done', result=result)
+
+def get_job(job_id):
+    """
+    Get the state of an analysis job.
+
+    Args:
+        job_id (int): ID of the job.
+
+    Returns:
+        tuple: Response message and status code.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    job = cur.execute("SELECT jobId, recordId, status, result, error, attempts, createdAt, startedAt, finishedAt FROM AnalysisJobs WHERE jobId=?", (job_id,)).fetchone()
+    if job:
+        return {"job": {
+            "jobId": job[0],
+            "recordId": job[1],
+            "status": job[2],
+            "result": None if job[3] is None else bool(job[3]),
+            "error": job[4],
+            "attempts": job[5],
+            "createdAt": job[6],
+            "startedAt": job[7],
+            "finishedAt": job[8]
+        }}, 200
+    else:
+        return {"error": "No job found with the given ID"}, 404
+
+def resume_analysis_jobs():
+    """
+    Queue again the jobs whose worker died, and submit every queued job to the process pool.
+
+    Called before the first request of each server process, so no upload is lost when the
+    server restarts with jobs in the queue. Several processes may submit the same job, only
+    one of them claims it.
+    """
+    con = database.connect_to_db()
+    try:
+        with con:
+            con.execute("UPDATE AnalysisJobs SET status='queued' WHERE status='running' AND startedAt < ?", ((datetime.now() - JOB_LEASE).isoformat(),))
+        job_ids = [row[0] for row in con.execute("SELECT jobId FROM AnalysisJobs WHERE status='queued'")]
+    finally:
+        con.close()
+    for job_id in job_ids:
+        get_executor().submit(run_analysis_job, job_id)
+
+class JourneyArchiveTooLarge(ValueError):
+    """
+    The uploaded archive holds too many journey files, or they are too large once uncompressed.
+    """
+
+def read_journey_archive(archive):
+    """
+    Read the journey files of a zip archive, each named after the ID of its record (e.g. '12.json').
+
+    The number of entries and their uncompressed sizes are checked against the limits
+    before any entry is decompressed, so a small zip bomb is rejected without using memory.
+    zipfile stops reading an entry at its declared size, so the sizes cannot be understated.
+
+    Args:
+        archive (file): The uploaded zip archive.
+
+    Returns:
+        list: (record_id, filename, trace) tuples.
+
+    Raises:
+        JourneyArchiveTooLarge: The archive is over MAX_BATCH_SIZE, MAX_ARCHIVE_ENTRY_SIZE or MAX_ARCHIVE_SIZE.
+        ValueError: The archive is not a zip file or an entry is not named after a record ID.
+    """
+    try:
+        with zipfile.ZipFile(archive) as zip_file:
+            entries = [entry for entry in zip_file.infolist() if not entry.is_dir()]
+            if len(entries) > MAX_BATCH_SIZE:
+                raise JourneyArchiveTooLarge(f"Too many journey files, the maximum is {MAX_BATCH_SIZE}")
+            for entry in entries:
+                if entry.file_size > MAX_ARCHIVE_ENTRY_SIZE:
+                    raise JourneyArchiveTooLarge(f"Entry '{entry.filename}' is larger than {MAX_ARCHIVE_ENTRY_SIZE} bytes")
+            if sum(entry.file_size for entry in entries) > MAX_ARCHIVE_SIZE:
+                raise JourneyArchiveTooLarge(f"The journey files are larger than {MAX_ARCHIVE_SIZE} bytes in total")
+            items = []
+            for entry in entries:
+                filename = os.path.basename(entry.filename)
+                record_id = os.path.splitext(filename)[0]
+                if not record_id.isdigit():
+                    raise ValueError(f"Invalid entry '{entry.filename}', files must be named after their record ID")
+                items.append((int(record_id), filename, zip_file.read(entry)))
+            return items
+    except zipfile.BadZipFile:
+        raise ValueError("Invalid zip archive")
+
+def analyse_batch(items):
+    """
+    Analyse many journey files at once and update their records in a single transaction.
+
+    The files not found in the analysis cache are analysed in parallel by the process pool,
+    then every record is updated with one executemany() per statement. Unlike the queued
+    jobs, the batch is analysed while the request waits, so it is meant for backfills and
+    offline sync uploads.
+
+    Args:
+        items (list): (record_id, filename, trace) tuples.
+
+    Returns:
+        tuple: Response message and status code.
+    """
+    if not items:
+        return {"error": "No journey file"}, 400
+    if len(items) > MAX_BATCH_SIZE:
+        return {"error": f"Too many journey files, the maximum is {MAX_BATCH_SIZE}"}, 413
+    record_ids = [record_id for record_id, _, _ in items]
+    if len(set(record_ids)) != len(record_ids):
+        return {"error": "Each record can only appear once in a batch"}, 400
+
+    digests = [trace_digest(trace) for _, _, trace in items]
+    cached = get_cached_analyses(digests)
+    futures = {}
+    for digest, (_, filename, trace) in zip(digests, items):
+        if digest not in cached and digest not in futures:
+            futures[digest] = get_executor().submit(analyse_and_cache_trace, trace, filename)
+    outcomes = []
+    results = []
+    for record_id, digest in zip(record_ids, digests):
+        try:
+            result, distance_by_modes = cached[digest] if digest in cached else futures[digest].result()
+        except Exception as e:
+            # If it fails during the process, set the associated record to rejected
+            outcomes.append((record_id, False, {}))
+            results.append({"recordId": record_id, "result": None, "error": f"Error during file analysis: {str(e)}"})
+            continue
+        outcomes.append((record_id, result, distance_by_modes))
+        results.append({"recordId": record_id, "result": bool(result), "error": None})
+
+    finalised = set(finalise_records(outcomes))
+    for item in results:
+        if item["recordId"] not in finalised and item["error"] is None:
+            item["error"] = "Record already finalised"
+    return {"results": results}, 200
@@ -1,10 +1,25 @@
 import os, json, datetime
+from werkzeug.utils import secure_filename
 import database
+from pagination import encode_cursor, decode_cursor
+from traces import encode_trace, decode_trace, is_trace
 
 JOURNEYS_FOLDER = "journeys/"
 
 MAX_JOURNEY_FILES = 1000
 
+# Fields of a journey returned by the journeys API
+JOURNEY_FIELDS = ("journeyId", "userId", "name", "methodsJson")
+
+# Extension of the journey files stored in the compact trace format
+TRACE_EXTENSION = ".trace"
+
+# Extensions of the journey files, JSON files are still read but no longer written
+JOURNEY_FILE_EXTENSIONS = (".json", TRACE_EXTENSION)
+
+# Compression of the journey files written by the server, 'zlib' or 'lzma' (smaller but slower)
+TRACE_COMPRESSION = "zlib"
+
 def journey_list_to_str_new(journey):
     """
     Convert a journey to a string.
@@ -69,16 +84,135 @@ def create_filename_from_journey_new(journey):
     date_str = datetime.datetime.now().strftime("%d_%m_%y_%H_%M_%S")
     return f"{journey_str}#{date_str}"
 
+def journey_modes_from_filename(filename):
+    """
+    Get the journey string of a journey file from its name.
+
+    Args:
+        filename (str): Name of the journey file, e.g. 'walk_bus-83#28_06_24_12_21_14.trace'.
+
+    Returns:
+        str: Journey string, e.g. 'walk_bus-83'.
+    """
+    return os.path.splitext(filename)[0].split('#')[0]
+
+@database.retry_on_locked
+def reserve_journey_file(filename, size):
+    """
+    Add a journey file to the manifest if the server can store it.
+
+    The quota is checked against the file count kept up to date by the manifest triggers,
+    in the same transaction as the insert, so concurrent uploads cannot exceed it.
+    Replacing an existing file is always allowed.
+
+    Args:
+        filename (str): Name of the journey file.
+        size (int): Size of the file in bytes.
+
+    Returns:
+        bool: True if the file was added, False if there are too many files on the server.
+    """
+    with database.transaction() as cur:
+        count = cur.execute("SELECT count FROM JourneyFileCounts WHERE id = 1").fetchone()[0]
+        if count >= MAX_JOURNEY_FILES and not cur.execute("SELECT 1 FROM JourneyFiles WHERE filename=?", (filename,)).fetchone():
+            return False
+        cur.execute("""
+            INSERT INTO JourneyFiles (filename, size, modes, createdAt) VALUES (?, ?, ?, ?)
+            ON CONFLICT (filename) DO UPDATE SET size = excluded.size, createdAt = excluded.createdAt
+        """, (filename, size, journey_modes_from_filename(filename), datetime.datetime.now().isoformat()))
+    return True
+
+@database.retry_on_locked
+def forget_journey_files(filenames):
+    """
+    Remove journey files from the manifest.
+
+    Args:
+        filenames (list): Names of the journey files.
+    """
+    with database.transaction() as cur:
+        cur.executemany("DELETE FROM JourneyFiles WHERE filename=?", [(filename,) for filename in filenames])
+
+def write_journey_file(filename, content):
+    """
+    Store a journey file if the server can store it.
+
+    Args:
+        filename (str): Name of the journey file.
+        content (bytes): Content of the file.
+
+    Returns:
+        bool: True if the file was stored, False if there are too many files on the server.
+    """
+    if not reserve_journey_file(filename, len(content)):
+        return False
+    try:
+        with open(os.path.join(JOURNEYS_FOLDER, filename), 'wb') as file:
+            file.write(content)
+    except OSError:
+        forget_journey_files([filename])
+        raise
+    return True
+
+def write_journey(name, journey_data):
+    """
+    Store journey data in the compact trace format if the server can store it.
+
+    Args:
+        name (str): Name of the journey file, without extension.
+        journey_data (dict): Journey data.
+
+    Returns:
+        bool: True if the file was stored, False if there are too many files on the server.
+    """
+    return write_journey_file(name + TRACE_EXTENSION, encode_trace(journey_data, TRACE_COMPRESSION))
+
+def parse_journey_file(content):
+    """
+    Decode the content of a journey file, whether it is stored as JSON or in the compact trace format.
+
+    Args:
+        content (bytes): Content of the journey file.
+
+    Returns:
+        dict: Journey data.
+
+    Raises:
+        ValueError: The content is neither a JSON object nor a valid compact trace.
+    """
+    if is_trace(content):
+        return decode_trace(content)
+    journey_data = json.loads(content)
+    if not isinstance(journey_data, dict):
+        raise ValueError("The journey is not a JSON object")
+    return journey_data
+
+def read_journey_file(filename):
+    """
+    Read a journey file, whether it is stored as JSON or in the compact trace format.
+
+    Args:
+        filename (str): Name of the journey file.
+
+    Returns:
+        dict: Journey data.
+    """
+    with open(os.path.join(JOURNEYS_FOLDER, filename), 'rb') as file:
+        content = file.read()
+    return parse_journey_file(content)
+
 def store_file(journey_data):
     """
     Store journey data to a file.
 
     Args:
         journey_data (dict): Journey data.
+
+    Returns:
+        bool: True if the file was stored, False if there are too many files on the server.
     """
     filename = create_filename_from_journey(journey_data["journey"])
-    with open(f"journeys/{filename}.json", 'w') as file:
-        json.dump(journey_data, file)
+    return write_journey(filename, journey_data)
 
 def store_file_new(journey_data):
     """
@@ -86,11 +220,59 @@ def store_file_new(journey_data):
 
     Args:
         journey_data (dict): Journey data.
+
+    Returns:
+        bool: True if the file was stored, False if there are too many files on the server.
     """
     journey = journey_data["journey"]["methodsJourneys"]
     filename = create_filename_from_journey_new(journey)
-    with open(f"{JOURNEYS_FOLDER}/{filename}.json", 'w') as file:
-        json.dump(journey_data, file)
+    return write_journey(filename, journey_data)
+
+def save_uploaded_journey_file(file):
+    """
+    Store an uploaded journey file under its own name.
+
+    The file is checked before its name is reserved in the manifest: its extension must be
+    one of JOURNEY_FILE_EXTENSIONS and its content must match it.
+
+    Args:
+        file (FileStorage): The uploaded JSON or compact trace file.
+
+    Returns:
+        bool: True if the file was stored, False if there are too many files on the server.
+
+    Raises:
+        ValueError: The name or the content of the file is not valid.
+    """
+    filename = secure_filename(file.filename)
+    name, extension = os.path.splitext(filename)
+    if not name or extension not in JOURNEY_FILE_EXTENSIONS:
+        raise ValueError(f"The file name must end with {' or '.join(JOURNEY_FILE_EXTENSIONS)}")
+    content = file.read()
+    if is_trace(content) != (extension == TRACE_EXTENSION):
+        raise ValueError(f"The content of {filename} does not match its extension")
+    try:
+        parse_journey_file(content)
+    except ValueError as e:
+        raise ValueError(f"{filename} is not a valid journey file: {e}")
+    return write_journey_file(filename, content)
+
+def list_journey_files():
+    """
+    List the stored journey files from the manifest, without reading the journeys folder.
+
+    Returns:
+        dict: Number and total size of the files, and the name, size, journey string and creation date of each file.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    count, total_size = cur.execute("SELECT count, totalSize FROM JourneyFileCounts WHERE id = 1").fetchone()
+    files = cur.execute("SELECT filename, size, modes, createdAt FROM JourneyFiles ORDER BY createdAt, filename").fetchall()
+    return {
+        "count": count,
+        "totalSize": total_size,
+        "files": [{"filename": file[0], "size": file[1], "modes": file[2], "createdAt": file[3]} for file in files]
+    }
 
 def get_journey_files():
     """
@@ -99,14 +281,118 @@ def get_journey_files():
     Returns:
         list: List of journey data.
     """
+    con = database.get_db()
+    cur = con.cursor()
+    filenames = [row[0] for row in cur.execute("SELECT filename FROM JourneyFiles ORDER BY createdAt, filename")]
     res = []
-    for journey_file in os.listdir(JOURNEYS_FOLDER):
-        if journey_file.endswith(".json"):
-            with open(JOURNEYS_FOLDER + journey_file) as file:
-                journey = json.load(file)
-            res.append(journey)
+    for filename in filenames:
+        try:
+            res.append(read_journey_file(filename))
+        except FileNotFoundError:
+            continue
     return res
 
+def encode_journey_cursor(created_at, filename):
+    """
+    Build the pagination cursor pointing after a journey file.
+
+    Args:
+        created_at (str): Creation date of the last file of the page.
+        filename (str): Name of the last file of the page.
+
+    Returns:
+        str: Opaque URL-safe cursor.
+    """
+    return encode_cursor(created_at, filename)
+
+def decode_journey_cursor(cursor):
+    """
+    Read a pagination cursor built by encode_journey_cursor().
+
+    Args:
+        cursor (str): Cursor sent by the client.
+
+    Returns:
+        tuple: Creation date and name of the last file of the previous page.
+
+    Raises:
+        ValueError: The cursor is malformed.
+    """
+    created_at, filename = decode_cursor(cursor, 2)
+    return str(created_at), str(filename)
+
+def find_journey_files(mode=None, since=None, until=None, cursor=None, limit=None):
+    """
+    Find a page of journey files in the manifest, ordered by creation date.
+
+    Args:
+        mode (str): Only keep the journeys whose journey string contains this mode, e.g. 'bus' or 'luas-Red'.
+        since (str): Only keep the files created at or after this ISO date.
+        until (str): Only keep the files created before this ISO date.
+        cursor (str): Cursor returned with the previous page.
+        limit (int): Maximum number of files in the page, all the files when None.
+
+    Returns:
+        tuple: Names of the files of the page, and the cursor of the next page or None if it is the last one.
+
+    Raises:
+        ValueError: The cursor is malformed.
+    """
+    conditions = []
+    params = []
+    if mode:
+        conditions.append("instr(modes, ?) > 0")
+        params.append(mode)
+    if since:
+        conditions.append("createdAt >= ?")
+        params.append(since)
+    if until:
+        conditions.append("createdAt < ?")
+        params.append(until)
+    if cursor:
+        conditions.append("(createdAt, filename) > (?, ?)")
+        params.extend(decode_journey_cursor(cursor))
+    query = "SELECT filename, createdAt FROM JourneyFiles"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY createdAt, filename"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+
+    con = database.get_db()
+    rows = con.execute(query, params).fetchall()
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        return [row[0] for row in rows], encode_journey_cursor(rows[-1][1], rows[-1][0])
+    return [row[0] for row in rows], None
+
+def iter_journey_lines(filenames):
+    """
+    Read journey files one at a time and yield each journey as a line of NDJSON.
+
+    Only one journey is held in memory at a time, whatever the number of files.
+
+    Args:
+        filenames (list): Names of the journey files.
+
+    Yields:
+        str: A journey serialized on a single line, followed by a newline.
+    """
+    for filename in filenames:
+        try:
+            with open(os.path.join(JOURNEYS_FOLDER, filename), 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            continue
+        if is_trace(content):
+            yield json.dumps(decode_trace(content)) + "\n"
+            continue
+        content = content.decode().strip()
+        if "\n" in content:
+            content = json.dumps(json.loads(content))
+        yield content + "\n"
+
 def delete_all_journey_files():
     """
     Delete all journey files.
@@ -114,9 +400,15 @@ def delete_all_journey_files():
     Returns:
         str: Deletion status message.
     """
-    for filename in os.listdir(JOURNEYS_FOLDER):
-        if filename.endswith(".json"):
-            os.remove(JOURNEYS_FOLDER + filename)
+    con = database.get_db()
+    cur = con.cursor()
+    filenames = [row[0] for row in cur.execute("SELECT filename FROM JourneyFiles")]
+    for filename in filenames:
+        try:
+            os.remove(os.path.join(JOURNEYS_FOLDER, filename))
+        except FileNotFoundError:
+            pass
+    forget_journey_files(filenames)
     return "Files were successfully deleted"
 
 def store_journey_file(journey_data):
@@ -129,17 +421,94 @@ def store_journey_file(journey_data):
     Returns:
         tuple: Response message and status code.
     """
-    if len(os.listdir(JOURNEYS_FOLDER)) < MAX_JOURNEY_FILES:
-        journey = journey_data["journey"]
-        journey_str = journey_list_to_str_new(journey)
-        date_str = datetime.datetime.now().strftime("%d_%m_%y_%H_%M_%S")
-        filename = f"{journey_str}#{date_str}.json"
-        with open(f"{JOURNEYS_FOLDER}/{filename}", 'w') as file:
-            json.dump(journey_data, file)
+    journey = journey_data["journey"]
+    journey_str = journey_list_to_str_new(journey)
+    date_str = datetime.datetime.now().strftime("%d_%m_%y_%H_%M_%S")
+    if write_journey(f"{journey_str}#{date_str}", journey_data):
         return "Data successfully stored on the server", 201
     else:
         return "Too many files on the server", 507
 
+@database.retry_on_locked
+def sync_journey_manifest():
+    """
+    Synchronise the manifest with the content of the journeys folder.
+
+    Called once at startup, so files added or removed by hand while the server was
+    stopped are taken into account, and before converting the journey files. These are
+    the only times the folder is listed.
+    """
+    files = {}
+    for entry in os.scandir(JOURNEYS_FOLDER):
+        if entry.name.endswith(JOURNEY_FILE_EXTENSIONS) and entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, datetime.datetime.fromtimestamp(stat.st_mtime).isoformat())
+    with database.transaction() as cur:
+        known = {row[0] for row in cur.execute("SELECT filename FROM JourneyFiles")}
+        cur.executemany("DELETE FROM JourneyFiles WHERE filename=?", [(filename,) for filename in known - files.keys()])
+        cur.executemany("INSERT INTO JourneyFiles (filename, size, modes, createdAt) VALUES (?, ?, ?, ?)", [
+            (filename, size, journey_modes_from_filename(filename), created_at)
+            for filename, (size, created_at) in files.items() if filename not in known
+        ])
+
+@database.retry_on_locked
+def rename_journey_file(old_filename, new_filename, size):
+    """
+    Replace a journey file by a new one in the manifest, keeping its creation date.
+
+    Args:
+        old_filename (str): Name of the replaced file.
+        new_filename (str): Name of the new file.
+        size (int): Size of the new file in bytes.
+    """
+    with database.transaction() as cur:
+        cur.execute("""
+            INSERT INTO JourneyFiles (filename, size, modes, createdAt)
+            SELECT ?, ?, modes, createdAt FROM JourneyFiles WHERE filename=?
+            ON CONFLICT (filename) DO UPDATE SET size = excluded.size, createdAt = excluded.createdAt
+        """, (new_filename, size, old_filename))
+        cur.execute("DELETE FROM JourneyFiles WHERE filename=?", (old_filename,))
+
+def convert_journey_files():
+    """
+    Convert the journey files stored as JSON to the compact trace format.
+
+    The manifest is synchronised with the journeys folder first, so files stored before
+    it existed are converted too. Each trace is written before the manifest is updated
+    and the JSON file removed, so an interrupted conversion can simply be run again.
+
+    Returns:
+        tuple: Number of files converted, total size before and after the conversion in bytes,
+            and names of the files that are not valid journeys and were kept.
+    """
+    sync_journey_manifest()
+    con = database.get_db()
+    filenames = [row[0] for row in con.execute("SELECT filename FROM JourneyFiles WHERE filename LIKE '%.json'")]
+    converted, size_before, size_after = 0, 0, 0
+    invalid = []
+    for filename in filenames:
+        path = os.path.join(JOURNEYS_FOLDER, filename)
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            continue
+        try:
+            trace = encode_trace(parse_journey_file(content), TRACE_COMPRESSION)
+        except ValueError:
+            invalid.append(filename)
+            continue
+        new_filename = os.path.splitext(filename)[0] + TRACE_EXTENSION
+        with open(os.path.join(JOURNEYS_FOLDER, new_filename), 'wb') as file:
+            file.write(trace)
+        rename_journey_file(filename, new_filename, len(trace))
+        os.remove(path)
+        converted += 1
+        size_before += len(content)
+        size_after += len(trace)
+    return converted, size_before, size_after, invalid
+
+@database.retry_on_locked
 def store_journey(data):
     """
     Store a new journey.
@@ -155,12 +524,11 @@ def store_journey(data):
     methods_json = data.get('methodsJson')
     if not user_id or not name or not methods_json:
         return {"error": "Invalid input data"}, 400
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     cur.execute("INSERT INTO Journeys (userId, name, methodsJson) VALUES (?, ?, ?)", (user_id, name, methods_json))
     con.commit()
     journey_id = cur.lastrowid
-    con.close()
     return {"message": "Journey created successfully", "journey": {"journeyId": journey_id, "userId": user_id, "name": name, "methodsJson": methods_json}}, 201
 
 def get_user_journeys(user_id):
@@ -173,16 +541,50 @@ def get_user_journeys(user_id):
     Returns:
         tuple: Response message and status code.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     journeys = cur.execute("SELECT * FROM Journeys WHERE userId=?", (user_id,)).fetchall()
-    con.close()
     if journeys:
         journeys_list = [{"journeyId": journey[0], "userId": journey[1], "name": journey[2], "methodsJson": journey[3]} for journey in journeys]
         return {"journeys": journeys_list}, 200
     else:
         return {"error": "No journeys found for the given user ID"}, 404
 
+def find_user_journeys(user_id, limit, cursor=None, fields=JOURNEY_FIELDS):
+    """
+    Get a page of the journeys of a user, ordered by journey ID.
+
+    Args:
+        user_id (int): ID of the user.
+        limit (int): Maximum number of journeys in the page.
+        cursor (str): Cursor returned with the previous page.
+        fields (tuple): Fields of each journey to return, among JOURNEY_FIELDS.
+
+    Returns:
+        dict: The journeys of the page, and the cursor of the next page or None if it is the last one.
+
+    Raises:
+        ValueError: The cursor is malformed.
+    """
+    query = f"SELECT {', '.join(fields)}, journeyId FROM Journeys WHERE userId=?"
+    params = [user_id]
+    if cursor:
+        query += " AND journeyId > ?"
+        try:
+            params.append(int(decode_cursor(cursor, 1)[0]))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+    query += " ORDER BY journeyId LIMIT ?"
+    params.append(limit + 1)
+
+    con = database.get_db()
+    rows = con.execute(query, params).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1][-1]) if len(rows) > limit else None
+    return {
+        "journeys": [dict(zip(fields, row)) for row in rows[:limit]],
+        "nextCursor": next_cursor
+    }
+
 def get_journey_details(journey_id):
     """
     Get details of a specific journey.
@@ -193,15 +595,15 @@ def get_journey_details(journey_id):
     Returns:
         tuple: Response message and status code.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     journey = cur.execute("SELECT * FROM Journeys WHERE journeyId=?", (journey_id,)).fetchone()
-    con.close()
     if journey:
         return {"journey": {"journeyId": journey[0], "userId": journey[1], "name": journey[2], "methods": json.loads(journey[3])}}, 200
     else:
         return {"error": "No journey found with the given ID"}, 404
 
+@database.retry_on_locked
 def remove_journey(journey_id):
     """
     Delete a specific journey by journey ID.
@@ -212,11 +614,10 @@ def remove_journey(journey_id):
     Returns:
         tuple: Response message and status code.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     result = cur.execute("DELETE FROM Journeys WHERE journeyId=?", (journey_id,))
     con.commit()
-    con.close()
     if result.rowcount == 0:
         return {"error": "No journey found with the given ID"}, 404
     else:
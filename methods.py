@@ -1,4 +1,12 @@
+import threading
+
 import database
+from analysis import get_emission_factors_version
+
+# Methods with their specifications, shared by every request of this process, and the emission factors version they were loaded at
+_methods_with_specifications = None
+_methods_version = None
+_methods_lock = threading.Lock()
 
 def get_method_specifications(method_id):
     """
@@ -10,10 +18,9 @@ def get_method_specifications(method_id):
     Returns:
         tuple: Response message and status code.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     specifications = cur.execute("SELECT * FROM MethodsSpecifications WHERE methodId=?", (method_id,)).fetchall()
-    con.close()
     if specifications:
         return {"specifications": [{"specificationId": spec[0], "methodId": spec[1], "name": spec[2]} for spec in specifications]}, 200
     else:
@@ -29,34 +36,55 @@ def get_method_details(method_id):
     Returns:
         tuple: Response message and status code.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     method = cur.execute("SELECT * FROM Methods WHERE methodId=?", (method_id,)).fetchone()
-    con.close()
     if method:
         return {"method": {"methodId": method[0], "name": method[1]}}, 200
     else:
         return {"error": "No method found with the given ID"}, 404
 
+def load_methods_with_specifications():
+    """
+    Load all methods with their specifications in a single query.
+
+    Returns:
+        list: Methods with the list of their specifications.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    rows = cur.execute("""
+        SELECT m.methodId, m.name, ms.specificationId, ms.methodId, ms.name
+        FROM Methods m
+        LEFT JOIN MethodsSpecifications ms ON ms.methodId = m.methodId
+        ORDER BY m.methodId, ms.specificationId
+    """).fetchall()
+    methods = {}
+    for method_id, method_name, specification_id, specification_method_id, specification_name in rows:
+        method_dict = methods.get(method_id)
+        if method_dict is None:
+            method_dict = methods[method_id] = {"methodId": method_id, "name": method_name, "specifications": []}
+        if specification_id is not None:
+            method_dict["specifications"].append({"specificationId": specification_id, "methodId": specification_method_id, "name": specification_name})
+    return list(methods.values())
+
 def get_all_methods_with_specifications():
     """
     Get all methods with their specifications.
 
+    The method catalogue is static reference data fetched by every client at startup,
+    so it is loaded once per process and kept until the EMISSION_FACTORS_CACHE version
+    changes. The version is bumped by triggers on the Methods and MethodsSpecifications
+    tables, so every process picks up an edited catalogue on its next request.
+
     Returns:
         tuple: Response message and status code.
     """
-    con = database.connect_to_db()
-    cur = con.cursor()
-    methods = cur.execute("SELECT * FROM Methods").fetchall()
-    methods_with_specifications = []
-    for method in methods:
-        method_id = method[0]
-        specifications = cur.execute("SELECT * FROM MethodsSpecifications WHERE methodId=?", (method_id,)).fetchall()
-        method_dict = {
-            "methodId": method[0],
-            "name": method[1],
-            "specifications": [{"specificationId": spec[0], "methodId": spec[1], "name": spec[2]} for spec in specifications]
-        }
-        methods_with_specifications.append(method_dict)
-    con.close()
-    return {"methods": methods_with_specifications}, 200
\ No newline at end of file
+    global _methods_with_specifications, _methods_version
+    version = get_emission_factors_version(database.get_db().cursor())
+    if _methods_with_specifications is None or _methods_version != version:
+        with _methods_lock:
+            if _methods_with_specifications is None or _methods_version != version:
+                _methods_with_specifications = load_methods_with_specifications()
+                _methods_version = version
+    return {"methods": _methods_with_specifications}, 200
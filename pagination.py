@@ -0,0 +1,71 @@
+import base64, json
+
+# The number of items in a page when only a cursor or fields are given
+DEFAULT_PAGE_SIZE = 50
+
+# The maximum number of items in a page
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(*values):
+    """
+    Build a pagination cursor from the sort key of the last item of a page.
+
+    Args:
+        values: Values of the sort key, e.g. a date and an ID.
+
+    Returns:
+        str: Opaque URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, length):
+    """
+    Read a pagination cursor built by encode_cursor().
+
+    Args:
+        cursor (str): Cursor sent by the client.
+        length (int): Number of values of the sort key.
+
+    Returns:
+        list: Values of the sort key of the last item of the previous page.
+
+    Raises:
+        ValueError: The cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return values
+
+def parse_page_args(args, allowed_fields):
+    """
+    Read the pagination parameters of a request.
+
+    Args:
+        args (dict): Query parameters 'limit', 'cursor' and 'fields' (comma-separated names).
+        allowed_fields (tuple): Names of the fields that can be returned, in their default order.
+
+    Returns:
+        tuple: Page size, cursor and fields to return, or None if no pagination parameter was given.
+
+    Raises:
+        ValueError: A parameter is malformed.
+    """
+    if not any(name in args for name in ("limit", "cursor", "fields")):
+        return None
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Invalid limit")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    fields = allowed_fields
+    if args.get("fields"):
+        fields = tuple(field.strip() for field in args["fields"].split(","))
+        unknown = [field for field in fields if field not in allowed_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return limit, args.get("cursor") or None, fields
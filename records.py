@@ -1,10 +1,42 @@
 import sqlite3
 import database
+from pagination import encode_cursor, decode_cursor
+
+# Fields of a record returned by the records API, 'journey' holding the name of its journey
+RECORD_FIELDS = ("recordId", "journeyId", "isValidated", "isPending", "jsonFileName", "points", "co2Saved",
+                 "nbMethodUsed", "kmTravelled", "startDate", "endDate", "journey")
+
+# Page of the records of a user that have a start date: the inner query walks
+# idx_records_journey backwards from the cursor for each journey of the user
+DATED_RECORDS_PAGE_QUERY = '''
+    SELECT {select}
+    FROM Journeys j
+    JOIN Records r ON r.recordId IN (
+        SELECT recordId FROM Records
+        WHERE journeyId = j.journeyId AND startDate IS NOT NULL{keyset}
+        ORDER BY startDate DESC, recordId DESC LIMIT ?
+    )
+    WHERE j.userId = ?
+    ORDER BY r.startDate DESC, r.recordId DESC LIMIT ?
+'''
+
+# Page of the records of a user without a start date, which come after all the dated ones
+UNDATED_RECORDS_PAGE_QUERY = '''
+    SELECT {select}
+    FROM Journeys j
+    JOIN Records r ON r.recordId IN (
+        SELECT recordId FROM Records
+        WHERE journeyId = j.journeyId AND startDate IS NULL{keyset}
+        ORDER BY recordId DESC LIMIT ?
+    )
+    WHERE j.userId = ?
+    ORDER BY r.recordId DESC LIMIT ?
+'''
 
 def get_all_user_records(user_id):    
-    con = database.connect_to_db()
-    con.row_factory = sqlite3.Row
+    con = database.get_db()
     cur = con.cursor()
+    cur.row_factory = sqlite3.Row
     
     query = '''
         SELECT r.*, j.name as journey_name
@@ -24,10 +56,62 @@ def get_all_user_records(user_id):
         records_list.append(record_dict)
     
     cur.close()
-    con.close()
 
     return records_list
 
+def find_user_records(user_id, limit, cursor=None, fields=RECORD_FIELDS):
+    """
+    Get a page of the records of a user, newest first.
+
+    The records are ordered by (startDate, recordId), records without a start date last,
+    and the page starts right after the cursor. The dated and the undated records are read
+    by separate queries on the raw indexed columns, so each journey of the user contributes
+    at most limit + 1 rows, read from idx_records_journey starting at the cursor, and only
+    those rows are sorted: a page costs the same whatever its position. Only the requested
+    columns are read.
+
+    Args:
+        user_id (int): ID of the user.
+        limit (int): Maximum number of records in the page.
+        cursor (str): Cursor returned with the previous page.
+        fields (tuple): Fields of each record to return, among RECORD_FIELDS.
+
+    Returns:
+        dict: The records of the page, and the cursor of the next page or None if it is the last one.
+
+    Raises:
+        ValueError: The cursor is malformed.
+    """
+    columns = [field for field in fields if field != "journey"]
+    select = ", ".join([f"r.{column}" for column in columns] + ["j.name", "r.startDate", "r.recordId"])
+    start_date = record_id = None
+    if cursor:
+        start_date, record_id = decode_cursor(cursor, 2)
+        if (start_date is not None and not isinstance(start_date, str)) or not isinstance(record_id, int):
+            raise ValueError("Invalid cursor")
+
+    con = database.get_db()
+    rows = []
+    if not cursor or start_date is not None:
+        keyset = " AND (startDate, recordId) < (?, ?)" if cursor else ""
+        params = ((start_date, record_id) if cursor else ()) + (limit + 1, user_id, limit + 1)
+        rows = con.execute(DATED_RECORDS_PAGE_QUERY.format(select=select, keyset=keyset), params).fetchall()
+    if len(rows) <= limit:
+        keyset = " AND recordId < ?" if cursor and start_date is None else ""
+        remaining = limit + 1 - len(rows)
+        params = ((record_id,) if keyset else ()) + (remaining, user_id, remaining)
+        rows += con.execute(UNDATED_RECORDS_PAGE_QUERY.format(select=select, keyset=keyset), params).fetchall()
+    records_list = []
+    for row in rows[:limit]:
+        record = dict(zip(columns, row))
+        if "journey" in fields:
+            journey_name = row[len(columns)]
+            record["journey"] = {"name": journey_name} if journey_name else None
+        records_list.append(record)
+    next_cursor = encode_cursor(*rows[limit - 1][-2:]) if len(rows) > limit else None
+    return {"records": records_list, "nextCursor": next_cursor}
+
+@database.retry_on_locked
 def store_record(data):
     """
     Store a new journey record.
@@ -47,7 +131,7 @@ def store_record(data):
     start_date = data.get('startDate')
     end_date = data.get('endDate')
 
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     cur.execute("""
         INSERT INTO Records (journeyId, isValidated, isPending, jsonFileName, points, co2Saved, startDate, endDate) 
@@ -55,7 +139,6 @@ def store_record(data):
     """, (journey_id, is_validated, is_pending, json_file_name, points, co2_saved, start_date, end_date))
     con.commit()
     record = cur.execute("SELECT * FROM Records WHERE recordId=?", (cur.lastrowid,)).fetchone()
-    con.close()
 
     return {
         "message": "Record created successfully",
@@ -72,4 +155,4 @@ def store_record(data):
             "startDate": record[9],
             "endDate": record[10]
         }
-    }, 201
\ No newline at end of file
+    }, 201
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+import database
+
+# SQL expression giving the Monday of the week of a record, as stored in WeeklyUserStats.weekStart
+RECORD_WEEK_START = "date(substr(r.startDate, 1, 10), 'weekday 0', '-6 days')"
+
+def get_start_end_of_week(date):
+    """
+    Get the start and end dates of the week for the given date.
+    Args:
+        date (datetime): The date for which to calculate the week start and end.
+    Returns:
+        tuple: Start and end dates of the week.
+    """
+    start = date - timedelta(days=date.weekday())
+    end = start + timedelta(days=6)
+    return start, end
+
+def add_record_to_weekly_stats(cur, record_id):
+    """
+    Add a validated record to the weekly statistics of its user.
+
+    Must run in the same transaction as the update storing the CO2e saved by the record.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor of the transaction validating the record.
+        record_id (int): ID of the validated record.
+    """
+    cur.execute(f'''
+        INSERT INTO WeeklyUserStats (weekStart, userId, routesCompleted, co2Saved, points)
+        SELECT {RECORD_WEEK_START}, j.userId, 1, COALESCE(r.co2Saved, 0), COALESCE(r.points, 0)
+        FROM Records r
+        JOIN Journeys j ON r.journeyId = j.journeyId
+        WHERE r.recordId = ? AND r.startDate IS NOT NULL
+        ON CONFLICT (weekStart, userId) DO UPDATE SET
+            routesCompleted = routesCompleted + 1,
+            co2Saved = co2Saved + excluded.co2Saved,
+            points = points + excluded.points
+    ''', (record_id,))
+
+def weekly_stats_query():
+    """
+    Build the query aggregating the validated records into WeeklyUserStats rows.
+
+    Returns:
+        str: Query returning (weekStart, userId, routesCompleted, co2Saved, points) rows.
+    """
+    return f'''
+        SELECT {RECORD_WEEK_START} AS weekStart, j.userId, COUNT(*), COALESCE(SUM(r.co2Saved), 0), COALESCE(SUM(r.points), 0)
+        FROM Records r
+        JOIN Journeys j ON r.journeyId = j.journeyId
+        WHERE r.isValidated = 1 AND r.isPending = 0 AND r.startDate IS NOT NULL
+        GROUP BY weekStart, j.userId
+    '''
+
+@database.retry_on_locked
+def rebuild_weekly_stats():
+    """
+    Rebuild the weekly statistics of every user from the validated records.
+
+    Returns:
+        int: Number of weekly rows written.
+    """
+    with database.transaction() as cur:
+        cur.execute("DELETE FROM WeeklyUserStats")
+        cur.execute(f"INSERT INTO WeeklyUserStats (weekStart, userId, routesCompleted, co2Saved, points) {weekly_stats_query()}")
+        return cur.execute("SELECT COUNT(*) FROM WeeklyUserStats").fetchone()[0]
+
+def get_leaderboard_position(cur, week_start, user_id):
+    """
+    Get the position of a user in the leaderboard of a week, ranked by CO2e saved.
+
+    The position is read from the (weekStart, co2Saved) index: one O(log n) seek for the
+    user, then a count over the index entries of the users ahead. The count walks one entry
+    per user ahead, so the whole lookup is O(log n + position): cheap near the top of the
+    leaderboard, and never a scan of the other weeks or of the users behind. Storing the
+    positions instead would make every validation shift the positions of the users it
+    passes, and a new entry those of every user behind it.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor to run the queries with.
+        week_start (str): Monday of the week (YYYY-MM-DD).
+        user_id (int): ID of the user.
+
+    Returns:
+        int: Position of the user, 0 if they have no validated record that week.
+    """
+    row = cur.execute("SELECT co2Saved FROM WeeklyUserStats WHERE weekStart=? AND userId=?", (week_start, user_id)).fetchone()
+    if row is None:
+        return 0
+    ahead = cur.execute("SELECT COUNT(*) FROM WeeklyUserStats WHERE weekStart=? AND co2Saved > ?", (week_start, row[0])).fetchone()[0]
+    return ahead + 1
+
+def build_weekly_roundup(user_id):
+    """
+    Build the roundup of the current week for a user.
+
+    Args:
+        user_id (int): ID of the user.
+
+    Returns:
+        dict: Routes completed, CO2e reduced, points earned, leaderboard position and places gained since last week.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+
+    start_of_week, _ = get_start_end_of_week(datetime.today())
+    week_start = start_of_week.strftime('%Y-%m-%d')
+    last_week_start = (start_of_week - timedelta(days=7)).strftime('%Y-%m-%d')
+
+    week = cur.execute("SELECT routesCompleted, co2Saved, points FROM WeeklyUserStats WHERE weekStart=? AND userId=?", (week_start, user_id)).fetchone()
+    routes_completed, co2_reduced, points_earned = week if week else (0, 0, 0)
+
+    position = get_leaderboard_position(cur, week_start, user_id)
+    last_week_position = get_leaderboard_position(cur, last_week_start, user_id)
+    places_gained = last_week_position - position if position and last_week_position else 0
+
+    return {
+        'routesCompleted': routes_completed,
+        'co2Reduced': co2_reduced,
+        'pointsEarned': points_earned,
+        'moneySaved': 0,    # To be completed if necessary
+        'leaderboardPosition': position,
+        'placesGained': places_gained,
+    }
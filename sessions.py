@@ -0,0 +1,157 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+import database
+
+# The time a session token stays valid after login, in seconds
+SESSION_MAX_AGE = 30 * 24 * 3600
+
+# The maximum number of verified session tokens kept by each process
+SESSION_CACHE_SIZE = 4096
+
+# The time a resolved session is trusted before the cache version of its user is read again, in seconds
+SESSION_RECHECK_INTERVAL = 5
+
+# Salt of the token signatures, so they cannot be mistaken for other values signed with the same key
+SESSION_SALT = "step-session"
+
+_serializer = None
+
+# Verified tokens of this process, least recently used first: token -> (user context, expiry time, user cache version, time of the version check)
+_session_cache = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+def init_app(app):
+    """
+    Configure the signature of the session tokens for a Flask application.
+
+    The signing key is read from the 'SECRET_KEY' config key, or the STEP_SECRET_KEY
+    environment variable. Every worker must share the same key, or the tokens issued by
+    one worker are rejected by the others, so startup fails without one. Only in debug or
+    testing mode is a random key generated instead, valid until the server restarts.
+
+    Args:
+        app (Flask): The application.
+
+    Raises:
+        RuntimeError: No signing key is configured outside debug and testing mode.
+    """
+    global _serializer
+    secret_key = app.config.get('SECRET_KEY') or os.environ.get('STEP_SECRET_KEY')
+    if not secret_key:
+        if not (app.debug or app.testing):
+            raise RuntimeError("STEP_SECRET_KEY must be set to the same value for every worker to sign the session tokens")
+        app.logger.warning("STEP_SECRET_KEY is not set, the session tokens will be invalidated when the server restarts")
+        secret_key = secrets.token_hex(32)
+    _serializer = URLSafeTimedSerializer(secret_key, salt=SESSION_SALT)
+    with _session_cache_lock:
+        _session_cache.clear()
+
+def issue_session_token(user_id, username):
+    """
+    Create a signed session token for a user who just logged in.
+
+    Args:
+        user_id (int): ID of the user.
+        username (str): Username of the user.
+
+    Returns:
+        str: URL-safe token to send in the 'Authorization: Bearer <token>' header.
+    """
+    return _serializer.dumps({"userId": user_id, "username": username, "sid": secrets.token_urlsafe(8)})
+
+def get_user_version(user_id):
+    """
+    Get the cache version of a user, bumped by triggers every time the user is modified or deleted.
+
+    Args:
+        user_id (int): ID of the user.
+
+    Returns:
+        int: Version of the user.
+    """
+    row = database.get_db().execute("SELECT version FROM CacheVersions WHERE name=?", (f"user:{user_id}",)).fetchone()
+    return row[0] if row else 0
+
+def resolve_session_token(token):
+    """
+    Get the user of a session token.
+
+    Each token is only verified once per process: later requests find it in the session
+    cache and do not touch the database. At most every SESSION_RECHECK_INTERVAL seconds,
+    the cache version of its user is read again, and the Users table when that version
+    changed. So the tokens of a user deleted by this process stop resolving straight away,
+    but those of a user deleted or renamed by another process keep resolving to the old
+    context for up to SESSION_RECHECK_INTERVAL seconds.
+
+    Args:
+        token (str): Token returned by issue_session_token().
+
+    Returns:
+        dict: User context with 'userId' and 'username', or None if the token is invalid or expired, or its user was deleted.
+    """
+    now = time.time()
+    with _session_cache_lock:
+        entry = _session_cache.get(token)
+        if entry is not None and entry[1] <= now:
+            del _session_cache[token]
+            entry = None
+
+    if entry is None:
+        try:
+            payload, signed_at = _serializer.loads(token, max_age=SESSION_MAX_AGE, return_timestamp=True)
+        except BadSignature:
+            return None
+        entry = ({"userId": payload["userId"], "username": payload["username"]}, signed_at.timestamp() + SESSION_MAX_AGE, None, None)
+
+    context, expires_at, version, checked_at = entry
+    if checked_at is not None and now - checked_at < SESSION_RECHECK_INTERVAL:
+        with _session_cache_lock:
+            if token in _session_cache:
+                _session_cache.move_to_end(token)
+        return context
+
+    current_version = get_user_version(context["userId"])
+    if version != current_version:
+        row = database.get_db().execute("SELECT username FROM Users WHERE userId=?", (context["userId"],)).fetchone()
+        if row is None:
+            forget_users([context["userId"]])
+            return None
+        context = {"userId": context["userId"], "username": row[0]}
+
+    with _session_cache_lock:
+        _session_cache[token] = (context, expires_at, current_version, now)
+        _session_cache.move_to_end(token)
+        if len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+    return context
+
+def forget_users(user_ids):
+    """
+    Drop the cached session tokens of users, e.g. after they were deleted.
+
+    Args:
+        user_ids (list): IDs of the users.
+    """
+    user_ids = set(user_ids)
+    with _session_cache_lock:
+        for token in [token for token, entry in _session_cache.items() if entry[0]["userId"] in user_ids]:
+            del _session_cache[token]
+
+def get_current_user():
+    """
+    Get the user of the current request from its 'Authorization: Bearer <token>' header.
+
+    Returns:
+        dict: User context with 'userId' and 'username', or None if the request has no valid session token.
+    """
+    if "session_user" not in g:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        g.session_user = resolve_session_token(token.strip()) if scheme.lower() == "bearer" and token.strip() else None
+    return g.session_user
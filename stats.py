@@ -0,0 +1,283 @@
+import threading
+from datetime import date, timedelta
+
+from flask import json
+
+import database
+from emissions import get_emission_stats_modes
+
+# Mode of the MonthlyStats rows holding the totals of each month, their usage is the number of records
+ALL_MODES = "all"
+
+# Expression giving the period of a CarbonEmissionStats row for each granularity (weeks start on Monday)
+STATS_GRANULARITIES = {
+    "day": "strftime('%Y-%m-%d', c.date)",
+    "week": "date(c.date, 'weekday 0', '-6 days')",
+    "month": "strftime('%Y-%m', c.date)",
+}
+
+# Aggregate computed for each mode by each statistics metric
+STATS_METRICS = {
+    "co2e": "SUM(c.co2e{mode})",
+    "km": "SUM(c.km{mode})",
+    "usage": "SUM(CASE WHEN c.is{mode}Used THEN 1 ELSE 0 END)",
+}
+
+# Length of the range returned when only the end of the range or the granularity is given
+DEFAULT_STATS_RANGE = timedelta(days=365)
+
+# The maximum number of serialized responses kept by the statistics cache of each process
+STATS_CACHE_SIZE = 256
+
+# Name of the CacheVersions row bumped every time the statistics change
+STATS_CACHE = "stats"
+
+# Serialized statistics responses of this process: key -> (version, body, etag)
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+
+def add_to_monthly_stats(cur, date, modes_used):
+    """
+    Add the statistics of a validated record to the monthly rollup.
+
+    Must run in the same transaction as the CarbonEmissionStats insert it mirrors. Only the
+    modes with their own CarbonEmissionStats columns are counted, in their own rows and in
+    the totals, like rebuild_monthly_stats() does, so a rebuild gives the same rollup.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor of the transaction inserting the CarbonEmissionStats row.
+        date (datetime): Date of the CarbonEmissionStats row.
+        modes_used (list): (mode, km, co2e) tuples for each mode used during the journey.
+    """
+    stats_modes = get_emission_stats_modes(cur)
+    modes_used = [(mode, km, co2e) for mode, km, co2e in modes_used if mode in stats_modes]
+    rows = [(date.year, date.month, mode, km, co2e, 1) for mode, km, co2e in modes_used]
+    rows.append((date.year, date.month, ALL_MODES, sum(km for _, km, _ in modes_used), sum(co2e for _, _, co2e in modes_used), 1))
+    cur.executemany('''
+        INSERT INTO MonthlyStats (year, month, mode, km, co2e, usage) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (year, month, mode) DO UPDATE SET
+            km = km + excluded.km,
+            co2e = co2e + excluded.co2e,
+            usage = usage + excluded.usage
+    ''', rows)
+    bump_stats_version(cur)
+
+def bump_stats_version(cur):
+    """
+    Invalidate the cached statistics responses of every process.
+
+    The version is stored in the database, so the web workers and the analysis workers
+    see the same value, and the bump is committed with the write it belongs to.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor of the transaction modifying the statistics.
+    """
+    cur.execute('''
+        INSERT INTO CacheVersions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+    ''', (STATS_CACHE,))
+
+def get_stats_version():
+    """
+    Get the current version of the statistics.
+
+    Returns:
+        int: Version bumped by every write to the statistics.
+    """
+    con = database.get_db()
+    row = con.execute("SELECT version FROM CacheVersions WHERE name=?", (STATS_CACHE,)).fetchone()
+    return row[0] if row else 0
+
+def get_cached_stats(key, build):
+    """
+    Get a serialized statistics response, built again only when the statistics changed.
+
+    Args:
+        key (str): Name of the response in the cache, e.g. the route.
+        build (callable): Function returning the statistics to serialize.
+
+    Returns:
+        tuple: JSON body and its ETag, which only changes with the statistics version.
+    """
+    version = get_stats_version()
+    entry = _response_cache.get(key)
+    if entry is None or entry[0] != version:
+        body = json.dumps(build())
+        entry = (version, body, f"{key}-{version}")
+        with _response_cache_lock:
+            if key not in _response_cache and len(_response_cache) >= STATS_CACHE_SIZE:
+                _response_cache.pop(next(iter(_response_cache)))
+            _response_cache[key] = entry
+    return entry[1], entry[2]
+
+def monthly_stats_query(modes, condition="1"):
+    """
+    Build the query aggregating the validated CarbonEmissionStats rows into MonthlyStats rows.
+
+    Args:
+        modes (list): Modes with their own CarbonEmissionStats columns, as returned by get_emission_stats_modes().
+        condition (str): SQL condition on CarbonEmissionStats (c) and Records (r) selecting the rows to aggregate.
+
+    The columns of the modes a row does not use may be NULL in rows stored before the rollup
+    existed, so they are summed with TOTAL(), which counts them as 0.
+
+    Returns:
+        str: Query returning (year, month, mode, km, co2e, usage) rows.
+    """
+    selects = [f'''
+        SELECT year, month, '{mode}' AS mode, TOTAL(c.km{mode}) AS km, TOTAL(c.co2e{mode}) AS co2e,
+               SUM(CASE WHEN c.is{mode}Used THEN 1 ELSE 0 END) AS usage
+        FROM ValidatedStats c
+        GROUP BY year, month
+        HAVING usage > 0
+    ''' for mode in modes]
+    selects.append(f'''
+        SELECT year, month, '{ALL_MODES}', {" + ".join(f"TOTAL(c.km{mode})" for mode in modes)},
+               {" + ".join(f"TOTAL(c.co2e{mode})" for mode in modes)}, COUNT(DISTINCT c.recordId)
+        FROM ValidatedStats c
+        GROUP BY year, month
+    ''')
+    return f'''
+        WITH ValidatedStats AS (
+            SELECT CAST(strftime('%Y', c.date) AS INTEGER) AS year, CAST(strftime('%m', c.date) AS INTEGER) AS month, c.*
+            FROM CarbonEmissionStats c
+            JOIN Records r ON c.recordId = r.recordId
+            WHERE r.isValidated = 1 AND r.isPending = 0 AND ({condition})
+        )
+        {" UNION ALL ".join(selects)}
+    '''
+
+def remove_from_monthly_stats(cur, condition, params=()):
+    """
+    Subtract validated CarbonEmissionStats rows from the monthly rollup, before they are deleted.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor of the transaction deleting the rows.
+        condition (str): SQL condition on CarbonEmissionStats (c) and Records (r) selecting the rows to subtract.
+        params (tuple): Parameters of the condition.
+    """
+    cur.execute(f'''
+        INSERT INTO MonthlyStats (year, month, mode, km, co2e, usage)
+        SELECT year, month, mode, -COALESCE(km, 0), -COALESCE(co2e, 0), -COALESCE(usage, 0)
+        FROM ({monthly_stats_query(get_emission_stats_modes(cur), condition)}) WHERE true
+        ON CONFLICT (year, month, mode) DO UPDATE SET
+            km = km + excluded.km,
+            co2e = co2e + excluded.co2e,
+            usage = usage + excluded.usage
+    ''', params)
+    bump_stats_version(cur)
+
+@database.retry_on_locked
+def rebuild_monthly_stats():
+    """
+    Rebuild the monthly rollup from the whole CarbonEmissionStats history.
+
+    Used to backfill the rollup, or to resynchronise it after CarbonEmissionStats or Records
+    were modified by hand.
+
+    Returns:
+        int: Number of rollup rows written.
+    """
+    with database.transaction() as cur:
+        cur.execute("DELETE FROM MonthlyStats")
+        cur.execute(f"INSERT INTO MonthlyStats (year, month, mode, km, co2e, usage) {monthly_stats_query(get_emission_stats_modes(cur))}")
+        bump_stats_version(cur)
+        return cur.execute("SELECT COUNT(*) FROM MonthlyStats").fetchone()[0]
+
+def get_monthly_stats(metric):
+    """
+    Get the statistics of each mode for each month of the year, all years combined.
+
+    Args:
+        metric (str): Column to report, 'co2e', 'km' or 'usage'.
+
+    Returns:
+        dict: A list of 12 monthly values for each mode, and the total number of records.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    rows = cur.execute(f'''
+        SELECT month, mode, SUM({metric}), SUM(usage)
+        FROM MonthlyStats
+        GROUP BY month, mode
+    ''').fetchall()
+
+    stats = {mode: [0]*12 for mode in get_emission_stats_modes(cur)}
+    stats["TotalRecords"] = 0
+
+    for month, mode, value, usage in rows:
+        if mode == ALL_MODES:
+            stats["TotalRecords"] += usage
+        elif mode in stats:
+            stats[mode][month - 1] = value
+
+    return stats
+
+def parse_stats_range(args):
+    """
+    Read the range parameters of a statistics request.
+
+    Args:
+        args (dict): Query parameters 'from' and 'to' (YYYY-MM-DD, both included) and 'granularity' (day, week or month).
+
+    Returns:
+        tuple: First day, last day and granularity, or None if no range parameter was given.
+
+    Raises:
+        ValueError: A parameter is malformed or the range is empty.
+    """
+    if not any(name in args for name in ("from", "to", "granularity")):
+        return None
+    granularity = args.get("granularity", "month")
+    if granularity not in STATS_GRANULARITIES:
+        raise ValueError(f"Invalid granularity, expected one of: {', '.join(STATS_GRANULARITIES)}")
+    try:
+        date_to = date.fromisoformat(args["to"]) if "to" in args else date.today()
+        date_from = date.fromisoformat(args["from"]) if "from" in args else date_to - DEFAULT_STATS_RANGE
+    except ValueError:
+        raise ValueError("Invalid date, expected YYYY-MM-DD")
+    if date_from > date_to:
+        raise ValueError("'from' must not be after 'to'")
+    return date_from, date_to, granularity
+
+def get_range_stats(metric, date_from, date_to, granularity):
+    """
+    Get the statistics of each mode for each period of a date range.
+
+    The range is applied with plain comparisons on CarbonEmissionStats.date so the date
+    index is used, and only the periods with validated records are returned.
+
+    Args:
+        metric (str): Column to report, 'co2e', 'km' or 'usage'.
+        date_from (date): First day of the range.
+        date_to (date): Last day of the range.
+        granularity (str): Length of a period, 'day', 'week' or 'month'.
+
+    Returns:
+        dict: The periods of the range, a list with one value per period for each mode, and the total number of records.
+    """
+    con = database.get_db()
+    cur = con.cursor()
+    modes = get_emission_stats_modes(cur)
+    aggregates = ", ".join(STATS_METRICS[metric].format(mode=mode) for mode in modes)
+    rows = cur.execute(f'''
+        SELECT {STATS_GRANULARITIES[granularity]} AS period, {aggregates}, COUNT(DISTINCT c.recordId)
+        FROM CarbonEmissionStats c
+        JOIN Records r ON c.recordId = r.recordId
+        WHERE c.date >= ? AND c.date < ?
+          AND r.isValidated = 1 AND r.isPending = 0
+        GROUP BY period
+        ORDER BY period
+    ''', (date_from.isoformat(), (date_to + timedelta(days=1)).isoformat())).fetchall()
+
+    stats = {
+        "from": date_from.isoformat(),
+        "to": date_to.isoformat(),
+        "granularity": granularity,
+        "periods": [row[0] for row in rows],
+    }
+    for index, mode in enumerate(modes, start=1):
+        stats[mode] = [row[index] for row in rows]
+    stats["TotalRecords"] = sum(row[-1] for row in rows)
+
+    return stats
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Tables of the production database the migrations build upon, with the reference data the analysis needs
+SCHEMA = """
+CREATE TABLE Companies(companyId INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE CompanyPositions(companyPositionId INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE Rewards(rewardId INTEGER PRIMARY KEY, name TEXT, cost INTEGER, companyId INTEGER);
+CREATE TABLE Users(userId INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, firstName TEXT, lastName TEXT, password TEXT, companyId INTEGER, companyPositionId INTEGER, points INTEGER, score INTEGER, lastMonthScore INTEGER, lastMonthScoreDate TEXT, lastWeekPosition INTEGER, lastWeekPositionDate TEXT, rewardGoalId INTEGER);
+CREATE TABLE Journeys(journeyId INTEGER PRIMARY KEY AUTOINCREMENT, userId INTEGER, name TEXT, methodsJson TEXT);
+CREATE TABLE Records(recordId INTEGER PRIMARY KEY AUTOINCREMENT, journeyId INTEGER, isValidated BOOLEAN, isPending BOOLEAN, jsonFileName TEXT, points INTEGER, co2Saved REAL, nbMethodUsed INTEGER, kmTravelled REAL, startDate TEXT, endDate TEXT);
+CREATE TABLE Methods(methodId INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE MethodsSpecifications(specificationId INTEGER PRIMARY KEY, methodId INTEGER, name TEXT);
+CREATE TABLE CarbonEmissionFactors(carbonEmissionFactorId INTEGER PRIMARY KEY, methodId INTEGER, co2eFactor REAL);
+CREATE TABLE CarbonEmissionFactorSpecifications(carbonEmissionFactorId INTEGER, methodId INTEGER, specificationId INTEGER);
+CREATE TABLE CarbonEmissionStats(carbonEmissionStatId INTEGER PRIMARY KEY AUTOINCREMENT, recordId INTEGER, date TIMESTAMP, isWalkUsed BOOLEAN, isDartUsed BOOLEAN, isLuasUsed BOOLEAN, isBikeUsed BOOLEAN, isCarUsed BOOLEAN, isBusUsed BOOLEAN, kmWalk REAL, kmDart REAL, kmLuas REAL, kmBike REAL, kmCar REAL, kmBus REAL, co2eWalk REAL, co2eDart REAL, co2eLuas REAL, co2eBike REAL, co2eCar REAL, co2eBus REAL);
+INSERT INTO Companies VALUES (1, 'TCD');
+INSERT INTO CompanyPositions VALUES (1, 'Student');
+INSERT INTO Methods VALUES (1, 'Walk'), (2, 'Bus'), (3, 'Luas'), (4, 'Bike'), (5, 'Car'), (6, 'Dart');
+INSERT INTO MethodsSpecifications VALUES (1, 5, 'Petrol'), (2, 5, 'Diesel'), (3, 5, 'Unknown');
+INSERT INTO CarbonEmissionFactors VALUES (1, 1, 0), (2, 2, 0.1), (3, 3, 0.03), (4, 4, 0), (5, 5, 0.17), (6, 5, 0.16), (7, 5, 0.17), (8, 6, 0.04);
+INSERT INTO CarbonEmissionFactorSpecifications VALUES (5, 5, 1), (6, 5, 2), (7, 5, 3);
+INSERT INTO Users (username, password, companyId, companyPositionId, points, score, lastMonthScore, lastWeekPosition) VALUES ('bob', 'pw', 1, 1, 0, 0, 0, 0);
+INSERT INTO Journeys (userId, name, methodsJson) VALUES (1, 'commute', '{}');
+INSERT INTO Records (journeyId, isValidated, isPending, points, co2Saved, startDate) VALUES (1, 0, 1, 0, 0, '2026-10-14T08:00:00Z');
+"""
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """
+    Create a migrated database in a temporary folder, and run the test from that folder.
+    """
+    path = str(tmp_path / "step.db")
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    con.close()
+    (tmp_path / "journeys").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STEP_DB_PATH", path)
+    monkeypatch.setenv("STEP_SECRET_KEY", "test")
+
+    import database
+    database.configure(path)
+    database.migrate()
+    return path
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+def test_cache_miss_does_not_wait_for_the_write_lock(db_path):
+    from app import app
+    import analysis
+    writer = sqlite3.connect(db_path)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        with app.app_context():
+            assert analysis.get_cached_analysis("0" * 64) is None
+    finally:
+        writer.rollback()
+        writer.close()
+
+def test_cache_evicts_the_least_recently_used_results(db_path, monkeypatch):
+    from app import app
+    import analysis
+    monkeypatch.setattr(analysis, "ANALYSIS_CACHE_SIZE", 2)
+    with app.app_context():
+        for digest in ("a", "b"):
+            analysis.store_cached_analysis(digest, True, {"walk": 1000})
+        assert analysis.get_cached_analysis("a") == (True, {"walk": 1000})
+        analysis.store_cached_analysis("c", False, {})
+        assert analysis.get_cached_analyses(["a", "b", "c"]) == {"a": (True, {"walk": 1000}), "c": (False, {})}
+
+    con = sqlite3.connect(db_path)
+    assert con.execute("SELECT digest, hits FROM AnalysisCache ORDER BY digest").fetchall() == [("a", 2), ("c", 1)]
+    con.close()
+
+def test_emission_factors_follow_changes_from_other_processes(db_path):
+    from app import app
+    import analysis
+    with app.app_context():
+        assert analysis.emission_factors.get("bus") == 0.1
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("UPDATE CarbonEmissionFactors SET co2eFactor = 0.2 WHERE methodId = 2")
+    con.close()
+    with app.app_context():
+        assert analysis.emission_factors.get("bus") == 0.2
+
+def test_recompute_skips_records_with_modes_without_columns(db_path):
+    from app import app
+    import analysis
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("INSERT INTO Records (journeyId, isValidated, isPending, startDate) VALUES (1, 0, 1, '2026-10-15T08:00:00Z')")
+    with app.app_context():
+        analysis.finalise_records([(1, True, {"bus": 5000}), (2, True, {"bus": 5000, "tram": 2000})])
+    with con:
+        con.execute("UPDATE CarbonEmissionFactors SET co2eFactor = 0.05 WHERE methodId = 2")
+    saved_before = dict(con.execute("SELECT recordId, co2Saved FROM Records"))
+
+    with app.app_context():
+        rows, skipped, _ = analysis.recompute_co2e()
+
+    assert (rows, skipped) == (1, 1)
+    saved_after = dict(con.execute("SELECT recordId, co2Saved FROM Records"))
+    assert saved_after[1] == pytest.approx(5 * 0.17 - 5 * 0.05)
+    assert saved_after[2] == saved_before[2]
+    con.close()
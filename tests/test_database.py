@@ -0,0 +1,32 @@
+import sqlite3
+
+import database
+from conftest import SCHEMA
+
+def test_migrated_schema_serves_every_hot_query_from_an_index(db_path):
+    database.migrate()
+
+    con = sqlite3.connect(db_path)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+    con.close()
+    assert database.check_query_plans() == {}
+
+def test_migrations_backfill_the_statistics_of_existing_records(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    with con:
+        con.execute("UPDATE Records SET isValidated = 1, isPending = 0, co2Saved = 0.5, points = 10 WHERE recordId = 1")
+        con.execute('''
+            INSERT INTO CarbonEmissionStats (recordId, date, isWalkUsed, isBusUsed, kmWalk, kmBus, co2eWalk, co2eBus)
+            VALUES (1, '2026-10-14 08:30:00', 1, 1, 1.0, 5.0, 0, 0.5)
+        ''')
+
+    database.configure(path)
+    database.migrate()
+
+    monthly = con.execute("SELECT year, month, mode, km, co2e, usage FROM MonthlyStats ORDER BY mode").fetchall()
+    assert monthly == [(2026, 10, "Bus", 5.0, 0.5, 1), (2026, 10, "Walk", 1.0, 0.0, 1), (2026, 10, "all", 6.0, 0.5, 1)]
+    weekly = con.execute("SELECT weekStart, userId, routesCompleted, co2Saved, points FROM WeeklyUserStats").fetchall()
+    assert weekly == [("2026-10-12", 1, 1, 0.5, 10)]
+    con.close()
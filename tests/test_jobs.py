@@ -0,0 +1,85 @@
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+import zipfile
+
+import pytest
+
+from conftest import ROOT
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+# Server run as a script: the analysis workers import this module again as __mp_main__, and the application with it
+SERVER_SCRIPT = textwrap.dedent("""
+    import sqlite3, sys, time
+    from app import app
+
+    if __name__ == "__main__":
+        app.test_client().get("/")
+        for _ in range(300):
+            status = sqlite3.connect(sys.argv[1]).execute("SELECT status FROM AnalysisJobs").fetchone()[0]
+            if status not in ("queued", "running"):
+                break
+            time.sleep(0.1)
+        print(status)
+""")
+
+def test_queued_job_is_resumed_when_workers_import_the_server(db_path, tmp_path):
+    trace = json.dumps({"dist": {"walk": 1000, "bus": 5000}}).encode()
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("INSERT INTO AnalysisJobs (recordId, filename, trace, createdAt) VALUES (1, '1.json', ?, '2026-10-14T08:00:00')", (trace,))
+    con.close()
+
+    script = tmp_path / "server.py"
+    script.write_text(SERVER_SCRIPT)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    completed = subprocess.run([sys.executable, str(script), db_path], cwd=tmp_path, env=env,
+                               capture_output=True, text=True, timeout=120)
+
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.strip().splitlines()[-1] == "done"
+    con = sqlite3.connect(db_path)
+    assert con.execute("SELECT isValidated, isPending FROM Records WHERE recordId=1").fetchone() == (1, 0)
+    con.close()
+
+def test_cached_upload_finalises_its_record(db_path):
+    from app import app
+    import analysis
+    trace = json.dumps({"dist": {"walk": 1000, "bus": 5000}}).encode()
+    with app.app_context():
+        analysis.store_cached_analysis(analysis.trace_digest(trace), True, {"walk": 1000, "bus": 5000})
+    client = app.test_client()
+
+    response = client.post("/api/analyse_journey_file", data={"recordId": "1", "file": (io.BytesIO(trace), "1.json")})
+    assert response.status_code == 200
+    assert response.json["job"]["status"] == "done"
+    con = sqlite3.connect(db_path)
+    assert con.execute("SELECT isValidated, isPending, kmTravelled FROM Records WHERE recordId=1").fetchone() == (1, 0, 6.0)
+    assert con.execute("SELECT COUNT(*) FROM CarbonEmissionStats WHERE recordId=1").fetchone()[0] == 1
+    con.close()
+
+    response = client.post("/api/analyse_journey_file", data={"recordId": "1", "file": (io.BytesIO(trace), "1.json")})
+    assert response.json["job"]["status"] == "failed"
+    assert response.json["job"]["error"] == "Record already finalised"
+
+@pytest.mark.parametrize("sizes", [[1] * 4, [200], [90, 90]], ids=["too many files", "file too large", "archive too large"])
+def test_oversized_archive_is_rejected_before_decompression(db_path, monkeypatch, sizes):
+    from app import app
+    import jobs
+    monkeypatch.setattr(jobs, "MAX_BATCH_SIZE", 3)
+    monkeypatch.setattr(jobs, "MAX_ARCHIVE_ENTRY_SIZE", 100)
+    monkeypatch.setattr(jobs, "MAX_ARCHIVE_SIZE", 150)
+    monkeypatch.setattr(zipfile.ZipFile, "read", lambda *args: pytest.fail("an entry was decompressed"))
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for record_id, size in enumerate(sizes, 1):
+            zip_file.writestr(f"{record_id}.json", b" " * size)
+    archive.seek(0)
+
+    response = app.test_client().post("/api/analyse_journey_files", data={"archive": (archive, "batch.zip")})
+    assert response.status_code == 413
@@ -0,0 +1,60 @@
+import io
+import json
+import os
+
+import pytest
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+JOURNEY = {"journey": {"methodsJourneys": []}, "gps": []}
+
+def upload(client, filename, content):
+    return client.post("/api/upload_journey_file", data={"file": (io.BytesIO(content), filename)})
+
+@pytest.mark.parametrize("filename, content", [
+    ("notes.txt", b"some notes"),
+    ("..json", json.dumps(JOURNEY).encode()),
+    ("walk.json", b"not json"),
+    ("walk.json", b"[1, 2]"),
+    ("walk.trace", json.dumps(JOURNEY).encode()),
+    ("walk.trace", b"STPT\x01\x00garbage"),
+])
+def test_invalid_journey_upload_is_rejected(db_path, filename, content):
+    from app import ADMIN_PASSWORD, app
+    client = app.test_client()
+
+    assert upload(client, filename, content).status_code == 400
+    response = client.get("/api/journey_data", json={"password": ADMIN_PASSWORD})
+    assert response.status_code == 200
+    assert response.json == []
+
+def test_valid_journey_upload_is_served(db_path):
+    from app import ADMIN_PASSWORD, app
+    client = app.test_client()
+
+    assert upload(client, "walk.json", json.dumps(JOURNEY).encode()).status_code == 201
+    response = client.get("/api/journey_data", json={"password": ADMIN_PASSWORD})
+    assert response.json == [JOURNEY]
+
+def test_conversion_lists_the_files_before_converting_them(db_path):
+    from app import app
+    import journeys
+    with open("journeys/walk.json", "w") as file:
+        json.dump(JOURNEY, file)
+    with open("journeys/broken.json", "w") as file:
+        file.write("[1, 2]")
+
+    result = app.test_cli_runner().invoke(args=["convert-journeys"])
+    assert result.exit_code == 0, result.output
+    assert "Journey files converted: 1," in result.output
+    assert "kept as they are: broken.json" in result.output
+    assert sorted(os.listdir("journeys")) == ["broken.json", "walk.trace"]
+    assert journeys.read_journey_file("walk.trace") == JOURNEY
+
+@pytest.mark.parametrize("cursor", ["WyJhIl0=", "W251bGxd", "not a cursor"])
+def test_malformed_journey_cursor_is_rejected(db_path, cursor):
+    from app import app
+
+    response = app.test_client().get("/api/journey/user/1", query_string={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json == {"error": "Invalid cursor"}
@@ -0,0 +1,20 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+def test_method_catalogue_follows_specification_changes(db_path):
+    from app import app
+    client = app.test_client()
+
+    def bus_specifications():
+        methods = client.get("/api/methods_with_specifications").json["methods"]
+        return [specification["name"] for method in methods if method["name"] == "Bus" for specification in method["specifications"]]
+
+    assert bus_specifications() == []
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("INSERT INTO MethodsSpecifications VALUES (6, 2, '46A')")
+    con.close()
+    assert bus_specifications() == ["46A"]
@@ -0,0 +1,33 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+def test_record_pages_cover_dated_then_undated_records(db_path):
+    from app import app
+    import database
+    import records
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("INSERT INTO Journeys (userId, name, methodsJson) VALUES (1, 'gym', '{}')")
+        con.executemany("INSERT INTO Records (journeyId, isValidated, isPending, startDate) VALUES (?, 0, 1, ?)", [
+            (2, "2026-10-16T08:00:00Z"), (1, None), (2, None), (1, "2026-10-16T08:00:00Z"), (2, "2026-10-13T08:00:00Z"),
+        ])
+    expected = [row[0] for row in con.execute('''
+        SELECT recordId FROM Records ORDER BY startDate IS NULL, startDate DESC, recordId DESC
+    ''')]
+    con.close()
+
+    pages = []
+    cursor = None
+    with app.app_context():
+        while True:
+            page = records.find_user_records(1, 2, cursor, ("recordId", "journey"))
+            pages.append([record["recordId"] for record in page["records"]])
+            cursor = page["nextCursor"]
+            if cursor is None:
+                break
+    assert sum(pages, []) == expected
+    assert [len(page) for page in pages] == [2, 2, 2]
+    assert not {"user records page", "user undated records page"} & set(database.check_query_plans())
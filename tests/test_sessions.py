@@ -0,0 +1,63 @@
+import logging
+
+import pytest
+from flask import Flask
+
+import sessions
+
+@pytest.fixture
+def keyless_app(monkeypatch):
+    monkeypatch.delenv("STEP_SECRET_KEY", raising=False)
+    monkeypatch.setattr(sessions, "_serializer", sessions._serializer)
+    return Flask("keyless")
+
+def test_startup_fails_without_a_signing_key(keyless_app):
+    with pytest.raises(RuntimeError):
+        sessions.init_app(keyless_app)
+
+def test_testing_mode_generates_a_key_with_a_warning(db_path, keyless_app, caplog):
+    keyless_app.testing = True
+    with caplog.at_level(logging.WARNING):
+        sessions.init_app(keyless_app)
+    assert "STEP_SECRET_KEY is not set" in caplog.text
+    with keyless_app.app_context():
+        token = sessions.issue_session_token(1, "bob")
+        assert sessions.resolve_session_token(token) == {"userId": 1, "username": "bob"}
+
+def test_deleted_user_tokens_stop_resolving(db_path):
+    pytest.importorskip("STEP_journey_checker.journey_checker")
+    from app import app
+    import users
+    with app.app_context():
+        token = sessions.issue_session_token(1, "bob")
+        assert sessions.resolve_session_token(token) == {"userId": 1, "username": "bob"}
+        users.delete_users([1])
+        assert sessions.resolve_session_token(token) is None
+
+def test_recently_resolved_token_skips_the_database(db_path, monkeypatch):
+    pytest.importorskip("STEP_journey_checker.journey_checker")
+    from app import app
+    with app.app_context():
+        token = sessions.issue_session_token(1, "bob")
+        assert sessions.resolve_session_token(token) == {"userId": 1, "username": "bob"}
+        monkeypatch.setattr(sessions.database, "get_db", lambda: pytest.fail("the database was read"))
+        assert sessions.resolve_session_token(token) == {"userId": 1, "username": "bob"}
+
+def test_tokens_follow_users_deleted_by_other_processes(db_path, monkeypatch):
+    pytest.importorskip("STEP_journey_checker.journey_checker")
+    import sqlite3
+    from app import app
+    monkeypatch.setattr(sessions, "SESSION_RECHECK_INTERVAL", 0)
+    with app.app_context():
+        token = sessions.issue_session_token(1, "bob")
+        assert sessions.resolve_session_token(token) == {"userId": 1, "username": "bob"}
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("UPDATE Users SET username='robert' WHERE userId=1")
+    with app.app_context():
+        assert sessions.resolve_session_token(token) == {"userId": 1, "username": "robert"}
+    with con:
+        con.execute("DELETE FROM Users WHERE userId=1")
+    con.close()
+    with app.app_context():
+        assert sessions.resolve_session_token(token) is None
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+def test_rebuild_reproduces_the_incremental_monthly_stats(db_path):
+    from app import app
+    import analysis
+    import stats
+    con = sqlite3.connect(db_path)
+    with con:
+        con.executemany("INSERT INTO Records (journeyId, isValidated, isPending, startDate) VALUES (1, 0, 1, ?)", [("2026-10-15",), ("2026-10-16",)])
+    with app.app_context():
+        analysis.finalise_records([
+            (1, True, {"walk": 1000, "bus": 5000}),
+            (2, True, {"bus": 3000, "tram": 4000}),
+            (3, True, {"tram": 2000}),
+        ])
+    query = "SELECT year, month, mode, round(km, 9), round(co2e, 9), usage FROM MonthlyStats ORDER BY year, month, mode"
+    incremental = con.execute(query).fetchall()
+
+    with app.app_context():
+        stats.rebuild_monthly_stats()
+
+    assert con.execute(query).fetchall() == incremental
+    assert [row[2:] for row in incremental if row[2] == stats.ALL_MODES] == [("all", 9.0, 0.8, 3)]
+    con.close()
+
+def test_new_emission_stats_mode_is_counted_in_the_monthly_stats(db_path):
+    from app import app
+    import analysis
+    import stats
+    con = sqlite3.connect(db_path)
+    with con:
+        for column in ("isTrainUsed BOOLEAN", "kmTrain REAL", "co2eTrain REAL"):
+            con.execute(f"ALTER TABLE CarbonEmissionStats ADD COLUMN {column}")
+    with app.app_context():
+        analysis.finalise_records([(1, True, {"walk": 1000, "train": 20000})])
+    query = "SELECT mode, round(km, 9), usage FROM MonthlyStats ORDER BY mode"
+    incremental = con.execute(query).fetchall()
+    assert incremental == [("Train", 20.0, 1), ("Walk", 1.0, 1), ("all", 21.0, 1)]
+
+    with app.app_context():
+        stats.rebuild_monthly_stats()
+        assert sum(stats.get_monthly_stats("usage")["Train"]) == 1
+
+    assert con.execute(query).fetchall() == incremental
+    con.close()
@@ -0,0 +1,49 @@
+import zlib
+
+import pytest
+
+import traces
+
+JOURNEY = {
+    "journey": {"methodsJourneys": [{"method": "walk"}]},
+    "gps": [
+        [-6.25123456789, 53.34123456449, "2024-06-28T12:21:14.912Z"],
+        [-6.2513, 53.3413, "2024-06-28T12:21:15.000Z"],
+        [-6.25129999, 53.34130001, "2024-06-28T12:21:16.004Z"],
+    ],
+}
+
+@pytest.mark.parametrize("compression", traces.COMPRESSORS)
+def test_trace_round_trip_rounds_coordinates_to_1e7_degrees(compression):
+    decoded = traces.decode_trace(traces.encode_trace(JOURNEY, compression))
+
+    assert decoded["journey"] == JOURNEY["journey"]
+    assert [point[2] for point in decoded["gps"]] == [point[2] for point in JOURNEY["gps"]]
+    for point, original in zip(decoded["gps"], JOURNEY["gps"]):
+        for value, original_value in zip(point[:2], original[:2]):
+            assert value == round(original_value * traces.COORDINATE_SCALE) / traces.COORDINATE_SCALE
+            assert abs(value - original_value) <= 0.5 / traces.COORDINATE_SCALE
+    assert decoded["gps"][0][:2] == [-6.2512346, 53.3412346]
+
+@pytest.mark.parametrize("journey", [{"gps": []}, {}, {"gps": [[1, 2]]}], ids=["no point", "no gps", "unpacked gps"])
+def test_trace_round_trip_without_packed_points(journey):
+    assert traces.decode_trace(traces.encode_trace(journey)) == journey
+
+def test_truncated_trace_is_rejected():
+    content = traces.encode_trace(JOURNEY)
+    for length in range(len(traces.TRACE_MAGIC), len(content)):
+        with pytest.raises(ValueError):
+            traces.decode_trace(content[:length])
+
+def test_truncated_payload_is_rejected():
+    content = traces.encode_trace(JOURNEY)
+    header = len(traces.TRACE_MAGIC) + 2
+    payload = zlib.decompress(content[header:])
+    for length in range(len(payload)):
+        with pytest.raises(ValueError, match="Corrupted trace"):
+            traces.decode_trace(content[:header] + zlib.compress(payload[:length]))
+
+@pytest.mark.parametrize("content", [b"", b"{}", b"STPT\x02\x00", b"STPT\x01\x07", b"STPT\x01\x00garbage"])
+def test_corrupt_trace_is_rejected(content):
+    with pytest.raises(ValueError):
+        traces.decode_trace(content)
@@ -0,0 +1,21 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("STEP_journey_checker.journey_checker")
+
+def test_cached_profile_follows_company_changes(db_path):
+    from app import app
+    import users
+    with app.app_context():
+        assert users.get_user(1)["company"]["name"] == "TCD"
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("DELETE FROM Companies WHERE companyId = 1")
+    with app.app_context():
+        assert users.get_user(1)["company"]["name"] is None
+    with con:
+        con.execute("INSERT INTO Companies VALUES (1, 'Trinity')")
+    con.close()
+    with app.app_context():
+        assert users.get_user(1)["company"]["name"] == "Trinity"
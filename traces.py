@@ -0,0 +1,205 @@
+import array, json, lzma, struct, sys, zlib
+from datetime import datetime, timedelta, timezone
+
+# First bytes of a compact trace file
+TRACE_MAGIC = b"STPT"
+
+# Version of the compact trace format
+TRACE_VERSION = 1
+
+# Coordinates are stored as integers in 1e-7 degrees (about 1 cm)
+COORDINATE_SCALE = 10_000_000
+
+# Format of the GPS timestamps sent by the apps, e.g. "2024-06-28T12:21:14.912Z"
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Compression algorithms: name -> (identifier stored in the header, compress, decompress)
+COMPRESSORS = {
+    "zlib": (0, lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (1, lzma.compress, lzma.decompress),
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
+
+def timestamp_to_ms(timestamp):
+    """
+    Convert a GPS timestamp to milliseconds since the epoch.
+
+    Args:
+        timestamp (str): Timestamp in TIMESTAMP_FORMAT with milliseconds.
+
+    Returns:
+        int: Milliseconds since the epoch, or None if the timestamp would not be restored identically.
+    """
+    try:
+        ms = (datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc) - EPOCH) // MILLISECOND
+    except (TypeError, ValueError):
+        return None
+    return ms if ms_to_timestamp(ms) == timestamp else None
+
+def ms_to_timestamp(ms):
+    """
+    Convert milliseconds since the epoch back to a GPS timestamp.
+
+    Args:
+        ms (int): Milliseconds since the epoch.
+
+    Returns:
+        str: Timestamp in TIMESTAMP_FORMAT with milliseconds.
+    """
+    return (EPOCH + ms * MILLISECOND).strftime("%Y-%m-%dT%H:%M:%S.") + f"{ms % 1000:03d}Z"
+
+def pack_column(values):
+    """
+    Delta-encode a column of integers into a typed array.
+
+    Args:
+        values (list): Integers to encode.
+
+    Returns:
+        bytes: Array typecode followed by the little-endian deltas.
+    """
+    deltas = [current - previous for previous, current in zip([0] + values, values)]
+    typecode = "i" if all(-2**31 <= delta < 2**31 for delta in deltas) else "q"
+    column = array.array(typecode, deltas)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return typecode.encode() + column.tobytes()
+
+def unpack_column(payload, offset, count):
+    """
+    Decode a column written by pack_column().
+
+    Args:
+        payload (bytes): Decompressed trace.
+        offset (int): Position of the column in the payload.
+        count (int): Number of values in the column.
+
+    Returns:
+        tuple: Decoded integers and position of the next column.
+
+    Raises:
+        ValueError: The column has an unknown type or is shorter than count values.
+    """
+    typecode = chr(payload[offset])
+    if typecode not in ("i", "q"):
+        raise ValueError(f"Corrupted trace: unknown column type {typecode!r}")
+    column = array.array(typecode)
+    end = offset + 1 + count * column.itemsize
+    if end > len(payload):
+        raise ValueError("Corrupted trace: truncated column")
+    column.frombytes(payload[offset + 1:end])
+    if sys.byteorder == "big":
+        column.byteswap()
+    values = []
+    total = 0
+    for delta in column:
+        total += delta
+        values.append(total)
+    return values, end
+
+def pack_gps(gps):
+    """
+    Split GPS points into fixed-point longitude, latitude and timestamp columns.
+
+    Args:
+        gps (list): GPS points as [longitude, latitude, timestamp].
+
+    Returns:
+        tuple: Longitudes, latitudes and timestamps as integers, or None if a point has another shape.
+    """
+    longitudes, latitudes, timestamps = [], [], []
+    for point in gps:
+        if not (isinstance(point, list) and len(point) == 3 and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in point[:2])):
+            return None
+        ms = timestamp_to_ms(point[2])
+        if ms is None:
+            return None
+        longitudes.append(round(point[0] * COORDINATE_SCALE))
+        latitudes.append(round(point[1] * COORDINATE_SCALE))
+        timestamps.append(ms)
+    return longitudes, latitudes, timestamps
+
+def encode_trace(journey_data, compression="zlib"):
+    """
+    Encode journey data in the compact trace format.
+
+    The GPS points are stored as delta-encoded fixed-point columns, everything else as
+    JSON, and the whole payload is compressed. Coordinates are rounded to 1e-7 degrees.
+    When the GPS points do not have the expected shape they are kept as JSON.
+
+    Args:
+        journey_data (dict): Journey data, with its GPS points under 'gps'.
+        compression (str): Name of the compression algorithm in COMPRESSORS.
+
+    Returns:
+        bytes: The encoded trace.
+    """
+    compression_id, compress, _ = COMPRESSORS[compression]
+    gps = journey_data.get("gps")
+    columns = pack_gps(gps) if isinstance(gps, list) else None
+    meta = dict(journey_data)
+    if columns is not None:
+        meta["gps"] = None
+    meta = json.dumps(meta, separators=(',', ':')).encode()
+
+    payload = struct.pack("<I", len(meta)) + meta
+    if columns is None:
+        payload += struct.pack("<?I", False, 0)
+    else:
+        payload += struct.pack("<?I", True, len(columns[0])) + b"".join(pack_column(column) for column in columns)
+    return TRACE_MAGIC + struct.pack("<BB", TRACE_VERSION, compression_id) + compress(payload)
+
+def decode_trace(content):
+    """
+    Decode a trace written by encode_trace().
+
+    Args:
+        content (bytes): The encoded trace.
+
+    Returns:
+        dict: The journey data.
+
+    Raises:
+        ValueError: The content is not a trace in a supported version, or it is corrupted.
+    """
+    if not is_trace(content):
+        raise ValueError("Not a compact trace")
+    try:
+        version, compression_id = struct.unpack_from("<BB", content, len(TRACE_MAGIC))
+        if version != TRACE_VERSION:
+            raise ValueError(f"Unsupported trace version {version}")
+        decompress = next(decompress for identifier, _, decompress in COMPRESSORS.values() if identifier == compression_id)
+        payload = decompress(content[len(TRACE_MAGIC) + 2:])
+
+        meta_length, = struct.unpack_from("<I", payload, 0)
+        journey_data = json.loads(payload[4:4 + meta_length])
+        if not isinstance(journey_data, dict):
+            raise ValueError("Corrupted trace: the journey is not an object")
+        packed, count = struct.unpack_from("<?I", payload, 4 + meta_length)
+        if packed:
+            offset = 4 + meta_length + struct.calcsize("<?I")
+            longitudes, offset = unpack_column(payload, offset, count)
+            latitudes, offset = unpack_column(payload, offset, count)
+            timestamps, offset = unpack_column(payload, offset, count)
+            journey_data["gps"] = [
+                [longitude / COORDINATE_SCALE, latitude / COORDINATE_SCALE, ms_to_timestamp(ms)]
+                for longitude, latitude, ms in zip(longitudes, latitudes, timestamps)
+            ]
+    except (struct.error, zlib.error, lzma.LZMAError, EOFError, StopIteration, IndexError, OverflowError,
+            json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Corrupted trace: {e}")
+    return journey_data
+
+def is_trace(content):
+    """
+    Check whether some content is a compact trace.
+
+    Args:
+        content (bytes): Content of a journey file.
+
+    Returns:
+        bool: True if the content starts with TRACE_MAGIC.
+    """
+    return content[:len(TRACE_MAGIC)] == TRACE_MAGIC
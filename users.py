@@ -1,5 +1,37 @@
+import hmac
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
 import database
+from images import remove_profile_images
+from sessions import forget_users
+from stats import remove_from_monthly_stats
+
+# Key derivation function used to hash the passwords, with all its cost parameters (see werkzeug.security).
+# Passwords hashed with other parameters are hashed again on the next successful login.
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+
+# Key derivation functions recognised in the password column, anything else is a password stored in plaintext
+PASSWORD_HASH_FUNCTIONS = ("scrypt", "pbkdf2")
+
+# Hash checked when the username does not exist, so an unknown username takes as long as a wrong password
+_dummy_password_hash = None
+
+# The maximum number of user profiles kept by the profile cache of each process
+PROFILE_CACHE_SIZE = 1024
 
+# Name of the CacheVersions row bumped every time a company, company position or reward changes
+PROFILES_CACHE = "profiles"
+
+# User profiles of this process, least recently used first: userId -> (versions, profile)
+_profile_cache = OrderedDict()
+_profile_cache_lock = threading.Lock()
+
+@database.retry_on_locked
 def create_user(data):
     """
     Creates a new user with a username and hashed password.
@@ -10,7 +42,7 @@ def create_user(data):
     Returns:
         user: The newly created user.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     cur.execute("""
         INSERT INTO Users (
@@ -18,83 +50,131 @@ def create_user(data):
             lastMonthScore, lastMonthScoreDate, lastWeekPosition, lastWeekPositionDate, rewardGoalId
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, (
-        data['username'], data['firstName'], data['lastName'], data['password'], data['companyId'], data['companyPositionId'], 
+        data['username'], data['firstName'], data['lastName'], hash_password(data['password']), data['companyId'], data['companyPositionId'], 
         data['points'], data['score'], data['lastMonthScore'], data['lastMonthScoreDate'],
         data['lastWeekPosition'], data['lastWeekPositionDate'], data['rewardGoalId']
     ))
     con.commit()
     inserted_user = cur.execute("SELECT * FROM Users WHERE username=?", (data['username'],)).fetchall()
-    con.close()
     return inserted_user
 
-def get_user(user_id):
+def load_user_profile(cur, user_id):
     """
-    Get a specific user by its identifier.
+    Read the profile of a user with its company, position and reward goal.
 
     Args:
+        cur (sqlite3.Cursor): Cursor to run the query with.
         user_id (int): Identifier of the user to fetch.
 
     Returns:
-        dict: The fetched user details.
+        dict: The user details, without the password, or None if the user does not exist.
     """
-    con = database.connect_to_db()
-    cur = con.cursor()
-    
-    user_query = """
-    SELECT u.userId, u.username, u.firstName, u.lastName, u.password, 
-           u.companyId, c.name as companyName, 
+    cur.row_factory = sqlite3.Row
+    user = cur.execute("""
+    SELECT u.userId, u.username, u.firstName, u.lastName,
+           u.companyId, c.name as companyName,
            u.companyPositionId, cp.name as companyPositionName,
            u.points, u.score, u.lastMonthScore, u.lastMonthScoreDate,
            u.lastWeekPosition, u.lastWeekPositionDate, u.rewardGoalId,
-           r.name as rewardName, r.cost, r.companyId as rewardCompanyId, rc.name as rewardCompanyName
+           r.name as rewardName, r.cost as rewardCost, r.companyId as rewardCompanyId, rc.name as rewardCompanyName
     FROM Users u
     LEFT JOIN Companies c ON u.companyId = c.companyId
     LEFT JOIN CompanyPositions cp ON u.companyPositionId = cp.companyPositionId
     LEFT JOIN Rewards r ON u.rewardGoalId = r.rewardId
     LEFT JOIN Companies rc ON r.companyId = rc.companyId
     WHERE u.userId = ?
-    """
-    
-    user = cur.execute(user_query, (user_id,)).fetchone()
-    con.close()
-    
-    if user:
-        userDic = {
-            "userId": user[0],
-            "username": user[1],
-            "firstName": user[2],
-            "lastName": user[3],
-            "password": user[4],
+    """, (user_id,)).fetchone()
+
+    if user is None:
+        return None
+    return {
+        "userId": user["userId"],
+        "username": user["username"],
+        "firstName": user["firstName"],
+        "lastName": user["lastName"],
+        "company": {
+            "companyId": user["companyId"],
+            "name": user["companyName"]
+        },
+        "companyPosition": {
+            "companyPositionId": user["companyPositionId"],
             "company": {
-                "companyId": user[5],
-                "name": user[6]
+                "companyId": user["companyId"],
+                "name": user["companyName"]
             },
-            "companyPosition": {
-                "companyPositionId": user[7],
-                "company": {
-                    "companyId": user[5],
-                    "name": user[6]
-                },
-                "name": user[8]
+            "name": user["companyPositionName"]
+        },
+        "points": user["points"],
+        "score": user["score"],
+        "lastMonthScore": user["lastMonthScore"],
+        "lastMonthScoreDate": user["lastMonthScoreDate"],
+        "lastWeekPosition": user["lastWeekPosition"],
+        "lastWeekPositionDate": user["lastWeekPositionDate"],
+        "rewardGoal": {
+            "rewardId": user["rewardGoalId"],
+            "cost": user["rewardCost"],
+            "company": {
+                "companyId": user["rewardCompanyId"],
+                "name": user["rewardCompanyName"]
             },
-            "points": user[9],
-            "score": user[10],
-            "lastMonthScore": user[11],
-            "lastMonthScoreDate": user[12],
-            "lastWeekPosition": user[13],
-            "lastWeekPositionDate": user[14],
-            "rewardGoal": {
-                "rewardId": user[15],
-                "cost": user[16],
-                "company": {
-                    "companyId": user[17],
-                    "name": user[18]
-                },
-                "name": user[19]
-            }
+            "name": user["rewardName"]
         }
-        return userDic
-    return None
+    }
+
+def get_profile_versions(cur, user_id):
+    """
+    Get the cache versions a user profile depends on.
+
+    The versions are bumped by triggers every time the user, or a company, position or
+    reward, is modified, whatever the process or tool doing it.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor to run the query with.
+        user_id (int): Identifier of the user.
+
+    Returns:
+        tuple: Version of the user and version of the companies, positions and rewards.
+    """
+    versions = dict(cur.execute("SELECT name, version FROM CacheVersions WHERE name IN (?, ?)", (f"user:{user_id}", PROFILES_CACHE)).fetchall())
+    return versions.get(f"user:{user_id}", 0), versions.get(PROFILES_CACHE, 0)
+
+def get_user(user_id):
+    """
+    Get a specific user by its identifier.
+
+    Profiles are cached by each process and only read again when the user, or a company,
+    position or reward, was modified since. The returned dictionary is shared by the
+    cache and must not be modified.
+
+    Args:
+        user_id (int): Identifier of the user to fetch.
+
+    Returns:
+        dict: The fetched user details, without the password.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    con = database.get_db()
+    cur = con.cursor()
+    versions = get_profile_versions(cur, user_id)
+
+    with _profile_cache_lock:
+        entry = _profile_cache.get(user_id)
+        if entry is not None and entry[0] == versions:
+            _profile_cache.move_to_end(user_id)
+            return entry[1]
+
+    profile = load_user_profile(cur, user_id)
+    if profile is None:
+        return None
+    with _profile_cache_lock:
+        _profile_cache[user_id] = (versions, profile)
+        _profile_cache.move_to_end(user_id)
+        if len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return profile
 
 def get_user_by_username(username):
     """
@@ -106,12 +186,98 @@ def get_user_by_username(username):
     Returns:
         user: The fetched user.
     """
-    con = database.connect_to_db()
+    con = database.get_db()
     cur = con.cursor()
     user = cur.execute("SELECT * FROM Users WHERE username=?", (username,)).fetchall()
-    con.close()
     return user
 
+def hash_password(password):
+    """
+    Hash a password with PASSWORD_HASH_METHOD and a random salt.
+
+    Args:
+        password (str): Password to hash.
+
+    Returns:
+        str: The hash to store in the password column.
+    """
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+def is_password_hash(stored_password):
+    """
+    Check whether the password column holds a hash or a password stored in plaintext.
+
+    Args:
+        stored_password (str): Value of the password column.
+
+    Returns:
+        bool: True if it is a hash generated by hash_password().
+    """
+    method = stored_password.split("$", 1)[0]
+    return stored_password.count("$") == 2 and method.split(":", 1)[0] in PASSWORD_HASH_FUNCTIONS
+
+def check_password(stored_password, password):
+    """
+    Check a password against the password column.
+
+    Args:
+        stored_password (str): Value of the password column, a hash or a password stored in plaintext.
+        password (str): Password to verify.
+
+    Returns:
+        tuple: Whether the password is valid, and whether the stored value must be hashed again with PASSWORD_HASH_METHOD.
+    """
+    if is_password_hash(stored_password):
+        valid = check_password_hash(stored_password, password)
+        return valid, valid and not stored_password.startswith(PASSWORD_HASH_METHOD + "$")
+    valid = hmac.compare_digest(stored_password.encode(), password.encode())
+    return valid, valid
+
+@database.retry_on_locked
+def rehash_password(user_id, stored_password, password):
+    """
+    Replace the stored password of a user by a hash with the current PASSWORD_HASH_METHOD.
+
+    Args:
+        user_id (int): ID of the user.
+        stored_password (str): Value of the password column checked at login, left untouched if it changed since.
+        password (str): Password the user logged in with.
+    """
+    con = database.get_db()
+    con.execute("UPDATE Users SET password=? WHERE userId=? AND password=?", (hash_password(password), user_id, stored_password))
+    con.commit()
+
+def authenticate_user(username, password):
+    """
+    Check user credentials with a single indexed lookup.
+
+    Passwords stored in plaintext, or hashed with older parameters, are hashed again
+    with PASSWORD_HASH_METHOD once the login succeeds.
+
+    Args:
+        username (str): Username of the user to be verified.
+        password (str): Password to verify.
+
+    Returns:
+        int: ID of the user if the credentials are valid, otherwise None.
+    """
+    global _dummy_password_hash
+    con = database.get_db()
+    user = con.execute("SELECT userId, password FROM Users WHERE username=?", (username,)).fetchone()
+    if user is None or not user[1] or not isinstance(password, str):
+        if _dummy_password_hash is None:
+            _dummy_password_hash = hash_password("")
+        check_password_hash(_dummy_password_hash, password if isinstance(password, str) else "")
+        return None
+
+    user_id, stored_password = user
+    valid, needs_rehash = check_password(stored_password, password)
+    if not valid:
+        return None
+    if needs_rehash:
+        rehash_password(user_id, stored_password, password)
+    return user_id
+
 def verify_user(username, password):
     """
     Checks user credentials.
@@ -123,14 +289,48 @@ def verify_user(username, password):
     Returns:
         bool: True if credentials are valid, otherwise False.
     """
-    user = get_user_by_username(username)
-    if user and user[0][4] == password:
-        return True
-    return False
+    return authenticate_user(username, password) is not None
+
+@database.retry_on_locked
+def delete_users(user_ids):
+    """
+    Delete users and everything that belongs to them, in a single transaction.
+
+    The journeys, records, CO2e statistics, analysis jobs and weekly statistics of the users
+    are removed with one set-based DELETE per table, and their validated journeys are
+    subtracted from the monthly statistics. Their profile pictures, cached profiles and
+    cached session tokens are dropped once the transaction is committed.
+
+    Args:
+        user_ids (list): IDs of the users to delete.
+
+    Returns:
+        list: IDs of the users that existed and were deleted.
+    """
+    ids = json.dumps([int(user_id) for user_id in user_ids])
+    users = "SELECT value FROM json_each(?)"
+    records = f"SELECT r.recordId FROM Records r JOIN Journeys j ON r.journeyId = j.journeyId WHERE j.userId IN ({users})"
+    with database.transaction() as cur:
+        deleted = [row[0] for row in cur.execute(f"SELECT userId FROM Users WHERE userId IN ({users})", (ids,))]
+        remove_from_monthly_stats(cur, f"c.recordId IN ({records})", (ids,))
+        cur.execute(f"DELETE FROM CarbonEmissionStats WHERE recordId IN ({records})", (ids,))
+        cur.execute(f"DELETE FROM AnalysisJobs WHERE recordId IN ({records})", (ids,))
+        cur.execute(f"DELETE FROM Records WHERE journeyId IN (SELECT journeyId FROM Journeys WHERE userId IN ({users}))", (ids,))
+        cur.execute(f"DELETE FROM Journeys WHERE userId IN ({users})", (ids,))
+        cur.execute(f"DELETE FROM WeeklyUserStats WHERE userId IN ({users})", (ids,))
+        cur.execute(f"DELETE FROM Users WHERE userId IN ({users})", (ids,))
+
+    with _profile_cache_lock:
+        for user_id in deleted:
+            _profile_cache.pop(user_id, None)
+    forget_users(deleted)
+    for user_id in deleted:
+        remove_profile_images(user_id)
+    return deleted
 
 def delete_user_by_id(user_id):
     """
-    Deletes a specific user.
+    Deletes a specific user and all their data.
 
     Args:
         user_id (int): ID of the user to delete.
@@ -139,15 +339,8 @@ def delete_user_by_id(user_id):
         bool: True if the user was successfully deleted, otherwise False.
     """
     try:
-        con = database.connect_to_db()
-        cur = con.cursor()
-        cur.execute("DELETE FROM Users WHERE userId = ?", (user_id,))
-        con.commit()
-        deleted_user = cur.execute("SELECT * FROM Users WHERE userId=?", (user_id,)).fetchone()
-        if deleted_user is None:
-            return True
-        else:
-            return False
+        delete_users([user_id])
+        return True
     except Exception as e:
         print(f"Error deleting user and associated data: {str(e)}")
-        return False
\ No newline at end of file
+        return False